@@ -0,0 +1,328 @@
+import datetime
+import json
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Union
+
+import optuna
+from optuna.storages import BaseStorage
+from optuna.trial import TrialState
+
+from optuna_mongo_storage.partitioned import PartitionedOptunaMongoStorage
+from optuna_mongo_storage.storage import OptunaMongoStorage
+from optuna_mongo_storage.storage import _merge_front
+
+MongoStorage = Union[OptunaMongoStorage, PartitionedOptunaMongoStorage]
+
+# fields of a serialized trial that are specific to the storage holding it
+_LOCAL_FIELDS = ("_id", "trial_id", "study_id", "finish_seq")
+_DATETIME_FIELDS = ("datetime_start", "datetime_complete")
+
+
+def _chunks(items: Iterable[Any], chunk_size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _target(storage: MongoStorage, study_id: int) -> OptunaMongoStorage:
+    if isinstance(storage, PartitionedOptunaMongoStorage):
+        return storage._study_storage(study_id)
+    return storage
+
+
+def _write_trials(
+    to_storage: MongoStorage,
+    study_id: int,
+    trial_docs: Iterable[Dict[str, Any]],
+    chunk_size: int,
+    n_workers: int,
+) -> int:
+    target = _target(to_storage, study_id)
+    directions = target._get_study_field(study_id, "directions")
+    front: List[Dict[str, Any]] = []
+    n_trials = 0
+
+    def collect(future: "Future[List[Dict[str, Any]]]") -> None:
+        nonlocal front
+        if len(directions) > 1:
+            entries = [
+                {"trial_id": t["trial_id"], "values": t["values"]}
+                for t in future.result()
+                if t["state"] == TrialState.COMPLETE.value and t["values"] is not None
+            ]
+            front = _merge_front(front, entries, directions)
+        else:
+            future.result()
+
+    # At most 2 * n_workers chunks are in memory at any time.
+    pending: List["Future[List[Dict[str, Any]]]"] = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for chunk in _chunks(trial_docs, chunk_size):
+            # numbers are reserved here so that they follow the order of the stream
+            first_number = target._reserve_numbers(study_id, len(chunk))
+            pending.append(
+                executor.submit(target._insert_trial_docs, study_id, chunk, first_number)
+            )
+            n_trials += len(chunk)
+            if len(pending) >= 2 * n_workers:
+                collect(pending.pop(0))
+        for future in pending:
+            collect(future)
+
+    if len(front) > 0:
+        target._merge_pareto_front(study_id, front, directions)
+    return n_trials
+
+
+def _create_study(
+    to_storage: MongoStorage,
+    study_name: str,
+    directions: List[int],
+    user_attrs: Dict[str, Any],
+    system_attrs: Dict[str, Any],
+) -> int:
+    study_id = to_storage.create_new_study(study_name)
+    to_storage.set_study_directions(
+        study_id, [optuna.study.StudyDirection(d) for d in directions]
+    )
+    for key, value in user_attrs.items():
+        to_storage.set_study_user_attr(study_id, key, value)
+    for key, value in system_attrs.items():
+        to_storage.set_study_system_attr(study_id, key, value)
+    return study_id
+
+
+def import_study(
+    from_storage: Union[str, BaseStorage, MongoStorage],
+    to_storage: MongoStorage,
+    from_study_name: str,
+    to_study_name: Optional[str] = None,
+    chunk_size: int = 1000,
+    n_workers: int = 4,
+) -> int:
+    """Copy a study from any Optuna storage into MongoDB storage.
+
+    Unlike :func:`optuna.copy_study`, trials are not replayed one by one. They are encoded in
+    chunks and written with parallel unordered bulk inserts.
+
+    .. note::
+        Optuna storages only offer :meth:`get_all_trials` for reading a study, so the source
+        trials are held in memory by the source storage. Use :func:`import_study_from_jsonl`
+        for constant memory.
+
+    Args:
+        from_storage:
+            Source storage, or its URL.
+        to_storage:
+            Destination storage.
+        from_study_name:
+            Name of the study to copy.
+        to_study_name:
+            Name of the new study. Defaults to ``from_study_name``.
+        chunk_size:
+            Number of trials per bulk write.
+        n_workers:
+            Number of concurrent bulk writes.
+    Returns:
+        ID of the new study.
+    """
+    if isinstance(from_storage, str):
+        from_storage = optuna.storages.get_storage(from_storage)
+    from_study_id = from_storage.get_study_id_from_name(from_study_name)
+
+    study_id = _create_study(
+        to_storage,
+        to_study_name or from_study_name,
+        [d.value for d in from_storage.get_study_directions(from_study_id)],
+        from_storage.get_study_user_attrs(from_study_id),
+        from_storage.get_study_system_attrs(from_study_id),
+    )
+    target = _target(to_storage, study_id)
+    trials = from_storage.get_all_trials(from_study_id, deepcopy=False)
+    _write_trials(
+        to_storage,
+        study_id,
+        (target._serialize_trial(study_id, t) for t in trials),
+        chunk_size,
+        n_workers,
+    )
+    return study_id
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+def export_study_to_jsonl(
+    storage: MongoStorage, study_name: str, path: str, chunk_size: int = 1000
+) -> int:
+    """Write a study of MongoDB storage to a JSON Lines file.
+
+    The first line holds the study, and each following line one trial in the storage's
+    document format, in trial number order. Trials are read ``chunk_size`` numbers at a time.
+    Args:
+        storage:
+            Source storage.
+        study_name:
+            Name of the study.
+        path:
+            Path of the file to write.
+        chunk_size:
+            Number of trials per read.
+    Returns:
+        Number of exported trials.
+    """
+    study_id = storage.get_study_id_from_name(study_name)
+    header = {
+        "study_name": study_name,
+        "directions": [d.value for d in storage.get_study_directions(study_id)],
+        "user_attrs": storage.get_study_user_attrs(study_id),
+        "system_attrs": storage.get_study_system_attrs(study_id),
+    }
+    n_trials = 0
+    with open(path, "w") as f:
+        f.write(json.dumps(header) + "\n")
+        for trial_doc in _iter_trial_docs(storage, study_id, chunk_size):
+            f.write(json.dumps(trial_doc, default=_encode) + "\n")
+            n_trials += 1
+    return n_trials
+
+
+def _iter_trial_docs(
+    storage: MongoStorage, study_id: int, chunk_size: int
+) -> Iterator[Dict[str, Any]]:
+    target = _target(storage, study_id)
+    study = target._collection("study", bulk=True).find_one(
+        {"study_id": study_id},
+        projection={"n_trials": 1, "archived": 1},
+        session=target._session(),
+    )
+    if study is None:
+        raise KeyError(study_id)
+    for start in range(0, study["n_trials"], chunk_size):
+        trial_docs = target._find_trial_docs(
+            study_id,
+            archived=study.get("archived", False),
+            numbers=(start, start + chunk_size),
+        )
+        for trial_doc in trial_docs:
+            yield {k: v for k, v in trial_doc.items() if k not in _LOCAL_FIELDS}
+
+
+def import_study_from_jsonl(
+    path: str,
+    to_storage: MongoStorage,
+    study_name: Optional[str] = None,
+    chunk_size: int = 1000,
+    n_workers: int = 4,
+) -> int:
+    """Create a study from a file written by :func:`export_study_to_jsonl`.
+
+    The file is streamed, so memory use is bounded by ``chunk_size * n_workers`` trials.
+    Args:
+        path:
+            Path of the file to read.
+        to_storage:
+            Destination storage.
+        study_name:
+            Name of the new study. Defaults to the name in the file.
+        chunk_size:
+            Number of trials per bulk write.
+        n_workers:
+            Number of concurrent bulk writes.
+    Returns:
+        ID of the new study.
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        study_id = _create_study(
+            to_storage,
+            study_name or header["study_name"],
+            header["directions"],
+            header["user_attrs"],
+            header["system_attrs"],
+        )
+
+        def trial_docs() -> Iterator[Dict[str, Any]]:
+            for line in f:
+                trial_doc = json.loads(line)
+                for field in _DATETIME_FIELDS:
+                    if trial_doc[field] is not None:
+                        trial_doc[field] = datetime.datetime.fromisoformat(trial_doc[field])
+                yield trial_doc
+
+        _write_trials(to_storage, study_id, trial_docs(), chunk_size, n_workers)
+    return study_id
+
+
+def export_study_to_arrow(
+    storage: MongoStorage, study_name: str, path: str, chunk_size: int = 1000
+) -> int:
+    """Write the trials of a study of MongoDB storage to an Arrow IPC file.
+
+    Each chunk of ``chunk_size`` trials becomes one record batch. Dictionary fields are
+    stored as JSON strings. Requires ``pyarrow``.
+    Args:
+        storage:
+            Source storage.
+        study_name:
+            Name of the study.
+        path:
+            Path of the file to write.
+        chunk_size:
+            Number of trials per record batch.
+    Returns:
+        Number of exported trials.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError(
+            "pyarrow is required to export to Arrow. Please run `pip install pyarrow`."
+        )
+
+    schema = pa.schema(
+        [
+            ("number", pa.int64()),
+            ("state", pa.string()),
+            ("values", pa.list_(pa.float64())),
+            ("datetime_start", pa.timestamp("us")),
+            ("datetime_complete", pa.timestamp("us")),
+            ("params", pa.string()),
+            ("distributions", pa.string()),
+            ("user_attrs", pa.string()),
+            ("system_attrs", pa.string()),
+            ("intermediate_values", pa.string()),
+        ]
+    )
+    study_id = storage.get_study_id_from_name(study_name)
+    n_trials = 0
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in _chunks(_iter_trial_docs(storage, study_id, chunk_size), chunk_size):
+            columns: Dict[str, List[Any]] = {name: [] for name in schema.names}
+            for trial_doc in chunk:
+                for name in schema.names:
+                    value = trial_doc[name]
+                    if name == "state":
+                        value = TrialState(value).name
+                    elif isinstance(value, dict):
+                        value = json.dumps(value, default=_encode)
+                    columns[name].append(value)
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+            n_trials += len(chunk)
+    return n_trials
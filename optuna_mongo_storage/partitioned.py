@@ -0,0 +1,424 @@
+import bisect
+import hashlib
+import uuid
+
+from typing import Any
+from typing import Callable
+from typing import Container
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import optuna
+from optuna.distributions import BaseDistribution
+from optuna.storages import BaseStorage
+from optuna.study._frozen import FrozenStudy
+from optuna.study._study_direction import StudyDirection
+from optuna.study._study_summary import StudySummary
+from optuna.trial import FrozenTrial
+from optuna.trial import TrialState
+
+import numpy as np
+from pymongo.errors import DuplicateKeyError
+
+from optuna_mongo_storage.storage import DEFAULT_STUDY_NAME_PREFIX
+from optuna_mongo_storage.storage import OptunaMongoStorage
+from optuna_mongo_storage.storage import _MISSING
+from optuna_mongo_storage.storage import _LRUCache
+
+# Number of low trial ID bits holding the partition number.
+PARTITION_BITS = 8
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class PartitionedOptunaMongoStorage(BaseStorage):
+
+    """A storage class placing each study on one of several MongoDB deployments.
+
+    A new study is placed by consistent hashing of its name. The placement is recorded in
+    the ``study_directory`` collection of the first deployment, so adding deployments later
+    never moves existing studies. The partition is also encoded into the low bits of every
+    trial ID, so trial-level calls are routed without a directory lookup.
+
+    Args:
+        urls:
+            MongoDB connection strings, one per partition. The order must not change once
+            studies have been created, since trial IDs refer to partitions by position.
+        db:
+            Name of the database on every partition, or a sequence of names, one per
+            partition. Distinct names let several partitions share one deployment.
+        virtual_nodes:
+            Number of points per partition on the hash ring.
+        bootstrap:
+            Result of :meth:`get_bootstrap` handed over by a parent process.
+        metadata_cache_size:
+            Maximum number of cached directory entries, also passed to every partition.
+            The entries of a study deleted by another process are still served until they
+            are evicted.
+        negative_cache_ttl:
+            Seconds for which a missing study is remembered, also passed to every partition.
+        kwargs:
+            Passed to :class:`~optuna_mongo_storage.storage.OptunaMongoStorage`.
+    """
+    def __init__(
+        self,
+        urls: Sequence[str],
+        db: Union[str, Sequence[str]] = "optuna",
+        virtual_nodes: int = 64,
+        bootstrap: Optional[Dict[str, Any]] = None,
+        metadata_cache_size: int = 1024,
+        negative_cache_ttl: float = 1.0,
+        **kwargs: Any,
+    ):
+        if len(urls) == 0:
+            raise ValueError("At least one partition is required.")
+        if len(urls) > (1 << PARTITION_BITS):
+            raise ValueError("At most {} partitions are supported.".format(1 << PARTITION_BITS))
+        if isinstance(db, str):
+            # the ring keys of a single database name stay the plain URLs
+            dbs = [db] * len(urls)
+            ring_names = list(urls)
+        else:
+            dbs = list(db)
+            if len(dbs) != len(urls):
+                raise ValueError("One database name per partition is required.")
+            ring_names = ["{}/{}".format(url, name) for url, name in zip(urls, dbs)]
+
+        self._partitions = []
+        for i, (url, db_name) in enumerate(zip(urls, dbs)):
+            partition_bootstrap = None
+            if bootstrap is not None:
+                partition_bootstrap = {"schema_version": bootstrap.get("schema_version")}
+                if bootstrap.get("partition") == i:
+                    partition_bootstrap = bootstrap
+            self._partitions.append(
+                OptunaMongoStorage(
+                    url,
+                    db_name,
+                    partition=i,
+                    partition_bits=PARTITION_BITS,
+                    bootstrap=partition_bootstrap,
+                    metadata_cache_size=metadata_cache_size,
+                    negative_cache_ttl=negative_cache_ttl,
+                    **kwargs,
+                )
+            )
+
+        # the directory and the study id counter live on the first partition
+        self._directory = self._partitions[0]
+
+        ring: List[Tuple[int, int]] = []
+        for partition, name in enumerate(ring_names):
+            for i in range(virtual_nodes):
+                ring.append((_hash("{}#{}".format(name, i)), partition))
+        ring.sort()
+        self._ring_keys = [k for k, _ in ring]
+        self._ring_partitions = [p for _, p in ring]
+
+        # placement of a study never changes, keys are ("partition", study_id) and
+        # ("id", study_name)
+        self._directory_cache = _LRUCache(metadata_cache_size, negative_cache_ttl)
+        if bootstrap is not None and "study_id" in bootstrap:
+            self._directory_cache.put(("partition", bootstrap["study_id"]), bootstrap["partition"])
+            self._directory_cache.put(("id", bootstrap["study_name"]), bootstrap["study_id"])
+
+    def close(self) -> None:
+        for storage in self._partitions:
+            storage.close()
+
+    def prewarm(self, study_name: Optional[str] = None) -> None:
+        self._directory.prewarm()
+        if study_name is not None:
+            self._study_storage(self.get_study_id_from_name(study_name)).prewarm(study_name)
+
+    def get_bootstrap(self, study_name: str) -> Dict[str, Any]:
+        study_id = self.get_study_id_from_name(study_name)
+        bootstrap = self._study_storage(study_id).get_bootstrap(study_name)
+        bootstrap["partition"] = self._partitions.index(self._study_storage(study_id))
+        return bootstrap
+
+    def _place(self, study_name: str) -> int:
+        index = bisect.bisect(self._ring_keys, _hash(study_name)) % len(self._ring_keys)
+        return self._ring_partitions[index]
+
+    # study_directory collection
+    # {
+    #   "study_id": id of study int
+    #   "study_name": name of study string
+    #   "partition": index of partition int
+    #  }
+    def _study_storage(self, study_id: int) -> OptunaMongoStorage:
+        partition = self._directory_cache.get(("partition", study_id))
+        if partition is None:
+            raise KeyError(study_id)
+        if partition is _MISSING:
+            entry = self._directory._collection("study_directory").find_one(
+                {"study_id": study_id},
+                projection={"partition": 1},
+                session=self._directory._session(),
+            )
+            if entry is None:
+                self._directory_cache.put_negative(("partition", study_id))
+                raise KeyError(study_id)
+            partition = entry["partition"]
+            self._directory_cache.put(("partition", study_id), partition)
+        return self._partitions[partition]
+
+    def _trial_storage(self, trial_id: int) -> OptunaMongoStorage:
+        partition = trial_id & ((1 << PARTITION_BITS) - 1)
+        if partition >= len(self._partitions):
+            raise KeyError(trial_id)
+        return self._partitions[partition]
+
+    # Basic study manipulation
+
+    def create_new_study(self, study_name: Optional[str] = None) -> int:
+        if study_name is None:
+            study_name = DEFAULT_STUDY_NAME_PREFIX + str(uuid.uuid4())
+
+        study_id = self._directory._next_id("study_id")
+        partition = self._place(study_name)
+        try:
+            self._directory._collection("study_directory").insert_one(
+                {"study_id": study_id, "study_name": study_name, "partition": partition},
+                session=self._directory._session(),
+            )
+        except DuplicateKeyError:
+            raise optuna.exceptions.DuplicatedStudyError(study_name)
+
+        try:
+            self._partitions[partition]._insert_study(study_id, study_name)
+        except Exception:
+            self._directory._collection("study_directory").delete_one(
+                {"study_id": study_id}, session=self._directory._session()
+            )
+            raise
+        self._directory_cache.pop(("id", study_name))
+        self._directory_cache.put(("partition", study_id), partition)
+        return study_id
+
+    def delete_study(self, study_id: int) -> None:
+        study_name = self.get_study_name_from_id(study_id)
+        self._study_storage(study_id).delete_study(study_id)
+        self._directory._collection("study_directory").delete_one(
+            {"study_id": study_id}, session=self._directory._session()
+        )
+        self._directory_cache.pop(("partition", study_id))
+        self._directory_cache.pop(("id", study_name))
+
+    def archive_study(self, study_id: int, chunk_size: int = 1000) -> None:
+        self._study_storage(study_id).archive_study(study_id, chunk_size)
+
+    def set_study_user_attr(self, study_id: int, key: str, value: Any) -> None:
+        self._study_storage(study_id).set_study_user_attr(study_id, key, value)
+
+    def set_study_system_attr(self, study_id: int, key: str, value: Any) -> None:
+        self._study_storage(study_id).set_study_system_attr(study_id, key, value)
+
+    def set_study_directions(self, study_id: int, directions: Sequence[StudyDirection]) -> None:
+        self._study_storage(study_id).set_study_directions(study_id, directions)
+
+    # Basic study access
+
+    def get_study_id_from_name(self, study_name: str) -> int:
+        study_id = self._directory_cache.get(("id", study_name))
+        if study_id is None:
+            raise KeyError(study_name)
+        if study_id is not _MISSING:
+            return study_id
+
+        entry = self._directory._collection("study_directory").find_one(
+            {"study_name": study_name},
+            projection={"study_id": 1, "partition": 1},
+            session=self._directory._session(),
+        )
+        if entry is None:
+            self._directory_cache.put_negative(("id", study_name))
+            raise KeyError(study_name)
+        self._directory_cache.put(("partition", entry["study_id"]), entry["partition"])
+        self._directory_cache.put(("id", study_name), entry["study_id"])
+        return entry["study_id"]
+
+    def get_study_id_from_trial_id(self, trial_id: int) -> int:
+        return self._trial_storage(trial_id).get_study_id_from_trial_id(trial_id)
+
+    def get_study_name_from_id(self, study_id: int) -> str:
+        return self._study_storage(study_id).get_study_name_from_id(study_id)
+
+    def get_study_directions(self, study_id: int) -> List[StudyDirection]:
+        return self._study_storage(study_id).get_study_directions(study_id)
+
+    def get_study_user_attrs(self, study_id: int) -> Dict[str, Any]:
+        return self._study_storage(study_id).get_study_user_attrs(study_id)
+
+    def get_study_system_attrs(self, study_id: int) -> Dict[str, Any]:
+        return self._study_storage(study_id).get_study_system_attrs(study_id)
+
+    def get_all_studies(self) -> List[FrozenStudy]:
+        studies = []
+        for storage in self._partitions:
+            studies.extend(storage.get_all_studies())
+        studies.sort(key=lambda s: s._study_id)
+        return studies
+
+    def get_all_study_summaries(self, include_best_trial: bool) -> List[StudySummary]:
+        summaries = []
+        for storage in self._partitions:
+            summaries.extend(storage.get_all_study_summaries(include_best_trial))
+        summaries.sort(key=lambda s: s._study_id)
+        return summaries
+
+    # Basic trial manipulation
+
+    def create_new_trial(self, study_id: int, template_trial: Optional[FrozenTrial] = None) -> int:
+        return self._study_storage(study_id).create_new_trial(study_id, template_trial)
+
+    def set_trial_param(
+        self,
+        trial_id: int,
+        param_name: str,
+        param_value_internal: float,
+        distribution: BaseDistribution,
+    ) -> None:
+        self._trial_storage(trial_id).set_trial_param(
+            trial_id, param_name, param_value_internal, distribution
+        )
+
+    def get_trial_id_from_study_id_trial_number(self, study_id: int, trial_number: int) -> int:
+        return self._study_storage(study_id).get_trial_id_from_study_id_trial_number(
+            study_id, trial_number
+        )
+
+    def get_trial_number_from_id(self, trial_id: int) -> int:
+        return self._trial_storage(trial_id).get_trial_number_from_id(trial_id)
+
+    def get_trial_param(self, trial_id: int, param_name: str) -> float:
+        return self._trial_storage(trial_id).get_trial_param(trial_id, param_name)
+
+    def set_trial_state_values(
+        self, trial_id: int, state: TrialState, values: Optional[Sequence[float]] = None
+    ) -> bool:
+        return self._trial_storage(trial_id).set_trial_state_values(trial_id, state, values)
+
+    def set_trial_intermediate_value(
+        self, trial_id: int, step: int, intermediate_value: float
+    ) -> None:
+        self._trial_storage(trial_id).set_trial_intermediate_value(
+            trial_id, step, intermediate_value
+        )
+
+    def set_trial_user_attr(self, trial_id: int, key: str, value: Any) -> None:
+        self._trial_storage(trial_id).set_trial_user_attr(trial_id, key, value)
+
+    def set_trial_system_attr(self, trial_id: int, key: str, value: Any) -> None:
+        self._trial_storage(trial_id).set_trial_system_attr(trial_id, key, value)
+
+    # Basic trial access
+
+    def get_trial(self, trial_id: int) -> FrozenTrial:
+        return self._trial_storage(trial_id).get_trial(trial_id)
+
+    def get_all_trials(
+        self,
+        study_id: int,
+        deepcopy: bool = True,
+        states: Optional[Container[TrialState]] = None,
+    ) -> List[FrozenTrial]:
+        return self._study_storage(study_id).get_all_trials(study_id, deepcopy, states)
+
+    def query_trials(
+        self,
+        study_ids: Sequence[int],
+        states: Optional[Container[TrialState]] = None,
+        fields: Optional[Sequence[str]] = None,
+        descending: bool = False,
+        cursor: Optional[Tuple[int, int]] = None,
+        limit: int = 1000,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[int, int]]]:
+        # Each partition pages its own studies from the same cursor. The merged page is
+        # complete up to the smallest next cursor of the partitions.
+        by_partition: Dict[int, List[int]] = {}
+        for study_id in study_ids:
+            try:
+                storage = self._study_storage(study_id)
+            except KeyError:
+                continue
+            by_partition.setdefault(self._partitions.index(storage), []).append(study_id)
+
+        sign = -1 if descending else 1
+
+        def key(study_id: int, number: int) -> Tuple[int, int]:
+            return sign * study_id, sign * number
+
+        trial_docs: List[Dict[str, Any]] = []
+        end: Optional[Tuple[int, int]] = None
+        for partition, ids in by_partition.items():
+            page, next_cursor = self._partitions[partition].query_trials(
+                ids, states, fields, descending, cursor, limit
+            )
+            trial_docs.extend(page)
+            if next_cursor is not None:
+                end = key(*next_cursor) if end is None else min(end, key(*next_cursor))
+
+        trial_docs.sort(key=lambda t: key(t["study_id"], t["number"]))
+        if end is not None:
+            trial_docs = [t for t in trial_docs if key(t["study_id"], t["number"]) <= end]
+        trial_docs = trial_docs[:limit]
+        if len(trial_docs) == limit:
+            return trial_docs, (trial_docs[-1]["study_id"], trial_docs[-1]["number"])
+        if end is not None:
+            return trial_docs, (sign * end[0], sign * end[1])
+        return trial_docs, None
+
+    def get_param_observations(
+        self, study_id: int, param_name: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return self._study_storage(study_id).get_param_observations(study_id, param_name)
+
+    def get_intermediate_value_percentiles(
+        self, study_id: int, step: int, percentiles: Sequence[float] = (50.0,)
+    ) -> Dict[str, Any]:
+        return self._study_storage(study_id).get_intermediate_value_percentiles(
+            study_id, step, percentiles
+        )
+
+    def get_pareto_front_trials(self, study_id: int) -> List[FrozenTrial]:
+        return self._study_storage(study_id).get_pareto_front_trials(study_id)
+
+    def get_n_trials(
+        self, study_id: int, state: Optional[Union[Tuple[TrialState, ...], TrialState]] = None
+    ) -> int:
+        return self._study_storage(study_id).get_n_trials(study_id, state)
+
+    def get_best_trial(self, study_id: int) -> FrozenTrial:
+        return self._study_storage(study_id).get_best_trial(study_id)
+
+    def get_trial_params(self, trial_id: int) -> Dict[str, Any]:
+        return self._trial_storage(trial_id).get_trial_params(trial_id)
+
+    def get_trial_user_attrs(self, trial_id: int) -> Dict[str, Any]:
+        return self._trial_storage(trial_id).get_trial_user_attrs(trial_id)
+
+    def get_trial_system_attrs(self, trial_id: int) -> Dict[str, Any]:
+        return self._trial_storage(trial_id).get_trial_system_attrs(trial_id)
+
+    def check_trial_is_updatable(self, trial_id: int, trial_state: TrialState) -> None:
+        self._trial_storage(trial_id).check_trial_is_updatable(trial_id, trial_state)
+
+    def read_trials_from_remote_storage(self, study_id: int) -> None:
+        self._study_storage(study_id).read_trials_from_remote_storage(study_id)
+
+    def is_heartbeat_enabled(self) -> bool:
+        return self._directory.is_heartbeat_enabled()
+
+    def get_heartbeat_interval(self) -> Optional[int]:
+        return self._directory.get_heartbeat_interval()
+
+    def get_failed_trial_callback(self) -> Optional[Callable[["optuna.Study", FrozenTrial], None]]:
+        return self._directory.get_failed_trial_callback()
@@ -1,56 +1,574 @@
-import abc
 import copy
 import datetime
-
-from tkinter.messagebox import NO
-from typing import Any, FrozenSet
+import math
+import threading
+import time
+import uuid
+import weakref
+import zlib
+
+from collections import OrderedDict
+from typing import Any
 from typing import Callable
-from typing import cast
 from typing import Container
 from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
+from typing import cast
 
+import bson
+import numpy as np
 import optuna
 from optuna.distributions import BaseDistribution
+from optuna.distributions import distribution_to_json
+from optuna.distributions import json_to_distribution
+from optuna.storages import BaseStorage
+from optuna.study._frozen import FrozenStudy
 from optuna.study._study_direction import StudyDirection
 from optuna.study._study_summary import StudySummary
 from optuna.trial import FrozenTrial
 from optuna.trial import TrialState
 
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.client_session import ClientSession
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest
+from pymongo.read_preferences import Primary
+from pymongo.read_preferences import PrimaryPreferred
+from pymongo.read_preferences import Secondary
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.write_concern import WriteConcern
 
 DEFAULT_STUDY_NAME_PREFIX = "no-name-"
 
-class Trial():
-    def __init__(self,number:int,study_id:int,datetime_start=None,datetime_complete=None):
-        self.number = number
-        self.study_id = study_id
-        self.datetime_start = datetime_start
-        self.datetime_complete = datetime_complete
+# Version of the collections and indexes layout. A database marked with this version in
+# its "meta" collection needs no index creation at connect time.
+SCHEMA_VERSION = 2
+
+# A trial ID is ((study_id << TRIAL_NUMBER_BITS | number) << partition_bits) | partition,
+# so the study and the number of a trial are known from its ID alone. Trial IDs are BSON
+# int64, which leaves 63 - TRIAL_NUMBER_BITS - partition_bits bits for the study ID.
+TRIAL_NUMBER_BITS = 32
+
+# Number of documents removed per delete round trip. Each batch waits for a majority
+# acknowledgement, which keeps huge deletes from running ahead of replication.
+DELETE_BATCH_SIZE = 1000
+
+# Durability profiles.
+# "fast" is used for high-volume, loss-tolerant writes (intermediate values, trial user attrs).
+# "safe" is used for study creation, ID allocation and trial state transitions.
+DURABILITY_FAST = "fast"
+DURABILITY_SAFE = "safe"
+
+DEFAULT_DURABILITY_PROFILES = {
+    DURABILITY_FAST: {
+        "write_concern": WriteConcern(w=1, j=False),
+        "read_concern": ReadConcern("local"),
+    },
+    DURABILITY_SAFE: {
+        "write_concern": WriteConcern(w="majority"),
+        "read_concern": ReadConcern("majority"),
+    },
+}
+
+_READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+_UPDATABLE_STATES = [TrialState.RUNNING.value, TrialState.WAITING.value]
+
+# A hole in the finish sequence of a study that stays unfilled this long (e.g. a worker
+# died between reserving a sequence number and finishing its trial) is skipped.
+_FINISH_SEQ_GAP_TIMEOUT = 60.0
+
+
+def _dominates(a: Sequence[float], b: Sequence[float]) -> bool:
+    # both points are in minimization form
+    return all(x <= y for x, y in zip(a, b)) and any(x < y for x, y in zip(a, b))
+
+
+def _merge_front(
+    front: List[Dict[str, Any]], entries: List[Dict[str, Any]], directions: List[int]
+) -> List[Dict[str, Any]]:
+    # Add entries ({"trial_id", "values"}) to a non-dominated set, checking each new
+    # point against the current front only.
+    signs = [-1.0 if d == StudyDirection.MAXIMIZE.value else 1.0 for d in directions]
+    front = list(front)
+    for entry in entries:
+        if any(other["trial_id"] == entry["trial_id"] for other in front):
+            continue
+        point = [s * v for s, v in zip(signs, entry["values"])]
+        new_front = []
+        dominated = False
+        for other in front:
+            other_point = [s * v for s, v in zip(signs, other["values"])]
+            if _dominates(other_point, point):
+                dominated = True
+                break
+            if not _dominates(point, other_point):
+                new_front.append(other)
+        if not dominated:
+            front = new_front + [entry]
+    return front
+
+
+def _keyset_filter(
+    study_ids: List[int],
+    cursor: Optional[Tuple[int, int]],
+    descending: bool,
+    continuation: Dict[str, Any],
+) -> Dict[str, Any]:
+    # Documents of the studies after the cursor study, plus the documents of the cursor study
+    # selected by ``continuation``.
+    if cursor is None:
+        return {"study_id": {"$in": study_ids}}
+    study_id = cursor[0]
+    later = [s for s in study_ids if (s < study_id if descending else s > study_id)]
+    branches: List[Dict[str, Any]] = [{"study_id": {"$in": later}}]
+    if study_id in study_ids:
+        branches.insert(0, dict(continuation, study_id=study_id))
+    return {"$or": branches}
+
+
+def _project(doc: Dict[str, Any], fields: Set[str]) -> Dict[str, Any]:
+    # Inclusion projection of dotted paths, the way the server applies it to hot trials.
+    projected: Dict[str, Any] = {}
+    for field in fields:
+        source, target = doc, projected
+        parents = field.split(".")
+        leaf = parents.pop()
+        for part in parents:
+            if not isinstance(source, dict) or part not in source:
+                break
+            source = source[part]
+            target = target.setdefault(part, {})
+        else:
+            if isinstance(source, dict) and leaf in source:
+                target[leaf] = source[leaf]
+    return projected
 
 
-class Study():
+_MISSING = object()
 
 
+class _LRUCache(object):
+    """Thread-safe bounded LRU cache.
 
-class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
+    Entries may expire. Misses are remembered for ``negative_ttl`` seconds only, since the
+    entry may be created later (e.g. a study created by another worker).
+    """
+
+    def __init__(self, maxsize: int, negative_ttl: float) -> None:
+        self._maxsize = maxsize
+        self._negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Any, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """Return the cached value, :obj:`None` for a cached miss, or ``_MISSING``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        self._set(key, value, None if ttl is None else time.monotonic() + ttl)
+
+    def put_negative(self, key: Any) -> None:
+        if self._negative_ttl > 0:
+            self._set(key, None, time.monotonic() + self._negative_ttl)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _set(self, key: Any, value: Any, expires: Optional[float]) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+class _SessionHolder(object):
+    """Thread-local owner of a session. The session ends once its thread is gone."""
+
+    def __init__(self, session: ClientSession) -> None:
+        self.session = session
+
+
+class _ParamObservations(object):
+    """Observation arrays of one parameter of one study, grown in place."""
+
+    def __init__(self) -> None:
+        self.watermark = 0  # every finish_seq <= watermark has been consumed
+        self.pending: Set[int] = set()  # consumed finish_seqs above the watermark
+        self.gap_since: Optional[float] = None
+        self.lock = threading.Lock()
+        self.size = 0
+        self.params = np.empty(16, dtype=np.float64)
+        self.values: Optional[np.ndarray] = None
+
+    def consume(self, seq: int, param: Optional[float], values: Optional[List[float]]) -> None:
+        if seq <= self.watermark or seq in self.pending:
+            return
+        self.pending.add(seq)
+        if param is None or values is None:
+            return
+        if self.values is None:
+            self.values = np.empty((len(self.params), len(values)), dtype=np.float64)
+        if self.size == len(self.params):
+            self.params = np.resize(self.params, 2 * self.size)
+            self.values = np.resize(self.values, (2 * self.size, self.values.shape[1]))
+        self.params[self.size] = param
+        self.values[self.size] = values
+        self.size += 1
+
+    def advance(self) -> None:
+        while True:
+            watermark = self.watermark
+            while self.watermark + 1 in self.pending:
+                self.watermark += 1
+                self.pending.remove(self.watermark)
+            if len(self.pending) == 0 or self.watermark != watermark:
+                # the hole at watermark + 1, if any, is a new one
+                self.gap_since = None
+            if len(self.pending) == 0:
+                return
+            now = time.monotonic()
+            if self.gap_since is None:
+                self.gap_since = now
+            if now - self.gap_since <= _FINISH_SEQ_GAP_TIMEOUT:
+                return
+            # only the hole that timed out is skipped, the next one is timed from now
+            self.watermark += 1
+            self.gap_since = None
+
+
+class OptunaMongoStorage(BaseStorage):
 
     """A storage class for storing and loading studies in MongoDB.
+
+    Args:
+        url:
+            MongoDB connection string.
+        db:
+            Name of the database.
+        durability_profiles:
+            Overrides for the durability profiles, keyed by profile name
+            (``"fast"`` or ``"safe"``). Each profile is a dictionary with optional
+            ``"write_concern"`` and ``"read_concern"`` entries.
+        bulk_read_preference:
+            Read preference mode used for bulk reads (:meth:`get_all_trials`,
+            :meth:`get_all_study_summaries`), e.g. ``"secondaryPreferred"``.
+            ID allocation and guarded writes always go to the primary.
+        max_staleness_seconds:
+            Maximum replication lag of a secondary used for bulk reads.
+            ``-1`` means no maximum.
+        causal_consistency:
+            If :obj:`True`, every operation of a thread runs in a causally consistent
+            session, so that bulk reads from secondaries always see the thread's own writes.
+        partition:
+            Partition number encoded into the low ``partition_bits`` bits of every trial ID.
+            Only used by :class:`~optuna_mongo_storage.partitioned.PartitionedOptunaMongoStorage`.
+        partition_bits:
+            Number of trial ID bits reserved for the partition number.
+        bucket_size:
+            If set, finished trials are packed into ``trial_bucket`` documents holding
+            ``bucket_size`` consecutive trial numbers each, while unfinished trials stay in
+            individual documents. This keeps the indexes and full-study reads of huge studies
+            small. :obj:`None` stores one document per trial.
+        percentile_cache_ttl:
+            Seconds for which a result of :meth:`get_intermediate_value_percentiles` is reused.
+        bootstrap:
+            Result of :meth:`get_bootstrap` handed over by a parent process. The study's ID,
+            name and directions are then known without a round trip, and index creation is
+            skipped if the schema version matches.
+        metadata_cache_size:
+            Maximum number of entries in the in-process cache of study IDs, names and
+            directions, which never change once set. The entries of a study deleted by
+            another process are still served until they are evicted.
+        negative_cache_ttl:
+            Seconds for which a missing study name or ID is remembered.
+
+    .. note::
+        No connection is made until the first call. Use :meth:`prewarm` to connect eagerly.
     """
-    def __init__(self, url:str="mongodb://127.0.0.1:27017", db:str="optuna"):
-        self.client = MongoClient(url)
-        self.db = self.client[db]
+    def __init__(
+        self,
+        url:str="mongodb://127.0.0.1:27017",
+        db:str="optuna",
+        durability_profiles: Optional[Dict[str, Dict[str, Any]]] = None,
+        bulk_read_preference: str = "primary",
+        max_staleness_seconds: int = -1,
+        causal_consistency: bool = True,
+        partition: int = 0,
+        partition_bits: int = 0,
+        bucket_size: Optional[int] = None,
+        percentile_cache_ttl: float = 1.0,
+        bootstrap: Optional[Dict[str, Any]] = None,
+        metadata_cache_size: int = 1024,
+        negative_cache_ttl: float = 1.0,
+    ):
+        self._url = url
+        self._db_name = db
+        self._client: Optional[MongoClient] = None
+        self._db: Optional[Database] = None
+        self._connect_lock = threading.Lock()
+
+        self._durability_profiles = copy.deepcopy(DEFAULT_DURABILITY_PROFILES)
+        if durability_profiles is not None:
+            for name, profile in durability_profiles.items():
+                if name not in self._durability_profiles:
+                    raise ValueError("Unknown durability profile: {}".format(name))
+                self._durability_profiles[name].update(profile)
+        self._collections: Dict[Tuple[str, str, bool], Collection] = {}
+
+        if bulk_read_preference not in _READ_PREFERENCES:
+            raise ValueError("Unknown read preference: {}".format(bulk_read_preference))
+        if bulk_read_preference == "primary":
+            self._bulk_read_preference = Primary()
+        else:
+            self._bulk_read_preference = _READ_PREFERENCES[bulk_read_preference](
+                max_staleness=max_staleness_seconds
+            )
+        self._causal_consistency = causal_consistency
+        self._sessions = threading.local()
+        self._session_finalizers: List[weakref.finalize] = []
+
+        if not 0 <= partition < (1 << partition_bits):
+            raise ValueError("partition {} does not fit in {} bits".format(partition, partition_bits))
+        self._partition = partition
+        self._partition_bits = partition_bits
+
+        if bucket_size is not None and bucket_size < 1:
+            raise ValueError("bucket_size must be positive")
+        self._bucket_size = bucket_size
+
+        self._observations: Dict[Tuple[int, str], _ParamObservations] = {}
+        self._observations_lock = threading.Lock()
+
+        self._percentile_cache_ttl = percentile_cache_ttl
+        # keys are (study_id, step, percentiles)
+        self._percentile_cache = _LRUCache(1024, 0.0)
+
+        # keys are ("id", study_name), ("name", study_id) and ("directions", study_id)
+        self._metadata = _LRUCache(metadata_cache_size, negative_cache_ttl)
+        self._schema_ready = False
+        if bootstrap is not None:
+            self._schema_ready = bootstrap.get("schema_version") == SCHEMA_VERSION
+            if "study_id" in bootstrap:
+                self._cache_study(bootstrap["study_id"], bootstrap["study_name"])
+                self._cache_directions(bootstrap["study_id"], bootstrap["directions"])
+
+    def _cache_study(self, study_id: int, study_name: str) -> None:
+        self._metadata.put(("id", study_name), study_id)
+        self._metadata.put(("name", study_id), study_name)
+
+    def _cache_directions(self, study_id: int, serialized_directions: List[int]) -> None:
+        # directions are immutable only once they are set
+        if StudyDirection.NOT_SET.value not in serialized_directions:
+            self._metadata.put(("directions", study_id), list(serialized_directions))
+
+    @property
+    def client(self) -> MongoClient:
+        if self._client is None:
+            self._connect()
+        return self._client
+
+    @property
+    def db(self) -> Database:
+        if self._db is None:
+            self._connect()
+        return self._db
+
+    def _connect(self) -> None:
+        with self._connect_lock:
+            if self._client is not None:
+                return
+            client = MongoClient(self._url)
+            self._db = client[self._db_name]
+            self._client = client
+        if not self._schema_ready:
+            self._ensure_indexes()
+
+    def close(self) -> None:
+        """End the sessions of all threads and close the connection.
+
+        The storage connects again on the next call.
+        """
+        with self._connect_lock:
+            finalizers, self._session_finalizers = self._session_finalizers, []
+            client, self._client, self._db = self._client, None, None
+            self._collections = {}
+            self._sessions = threading.local()
+        for finalizer in finalizers:
+            finalizer()
+        if client is not None:
+            client.close()
+
+    def prewarm(self, study_name: Optional[str] = None) -> None:
+        """Connect to the server, and optionally load the metadata of a study.
+
+        Args:
+            study_name:
+                Name of a study whose ID and directions are loaded.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_name`` exists.
+        """
+        self._connect()
+        # MongoClient connects lazily, and a bootstrapped storage skips the schema check,
+        # so the ping is what opens the connection.
+        self.db.command("ping")
+        self._session()
+        if study_name is not None:
+            self.get_study_directions(self.get_study_id_from_name(study_name))
+
+    def get_bootstrap(self, study_name: str) -> Dict[str, Any]:
+        """Read what a worker process needs to start working on a study without setup calls.
+
+        The result is JSON serializable and meant to be passed as ``bootstrap`` to the
+        storage of a short-lived worker.
+        Args:
+            study_name:
+                Name of the study.
+        Returns:
+            Dictionary with the schema version, the study ID, the study name and the
+            serialized directions.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_name`` exists.
+        """
+        study = self._collection("study").find_one(
+            {"study_name": study_name},
+            projection={"study_id": 1, "directions": 1},
+            session=self._session(),
+        )
+        if study is None:
+            raise KeyError(study_name)
+        return {
+            "schema_version": SCHEMA_VERSION,
+            "study_id": study["study_id"],
+            "study_name": study_name,
+            "directions": study["directions"],
+        }
+
+    def _collection(
+        self, name: str, profile: str = DURABILITY_SAFE, bulk: bool = False
+    ) -> Collection:
+        # Collection objects are cheap, but we cache them to avoid rebuilding options per call.
+        key = (name, profile, bulk)
+        if key not in self._collections:
+            options = self._durability_profiles[profile]
+            self._collections[key] = self.db.get_collection(
+                name,
+                write_concern=options.get("write_concern"),
+                read_concern=options.get("read_concern"),
+                read_preference=self._bulk_read_preference if bulk else Primary(),
+            )
+        return self._collections[key]
+
+    def _session(self) -> Optional[ClientSession]:
+        # Sessions are not thread-safe, so each thread gets its own one.
+        if not self._causal_consistency:
+            return None
+        holder = getattr(self._sessions, "holder", None)
+        if holder is None:
+            session = self.client.start_session(causal_consistency=True)
+            holder = _SessionHolder(session)
+            # A thread's locals are dropped when it exits, which returns the server session
+            # to the client's pool instead of leaving it open until the server times it out.
+            finalizer = weakref.finalize(holder, session.end_session)
+            finalizer.atexit = False
+            with self._connect_lock:
+                self._session_finalizers = [f for f in self._session_finalizers if f.alive]
+                self._session_finalizers.append(finalizer)
+            self._sessions.holder = holder
+        return holder.session
+
+    # meta collection
+    # {
+    #   "_id": "schema"
+    #   "version": SCHEMA_VERSION of the database int
+    #  }
+    def _ensure_indexes(self) -> None:
+        # One read instead of a dozen create_index round trips on an up-to-date database.
+        meta = self._collection("meta").find_one({"_id": "schema"})
+        if meta is not None and meta["version"] >= SCHEMA_VERSION:
+            self._schema_ready = True
+            return
+
+        self._collection("study").create_index("study_id", unique=True)
+        self._collection("study").create_index("study_name", unique=True)
+        self._collection("trial").create_index("trial_id", unique=True)
+        self._collection("trial").create_index(
+            [("study_id", ASCENDING), ("number", ASCENDING)], unique=True
+        )
+        self._collection("trial").create_index(
+            [("study_id", ASCENDING), ("finish_seq", ASCENDING)]
+        )
+        self._collection("trial_bucket").create_index(
+            [("study_id", ASCENDING), ("bucket", ASCENDING)], unique=True
+        )
+        self._collection("trial_archive").create_index(
+            [("study_id", ASCENDING), ("chunk", ASCENDING)], unique=True
+        )
+        self._collection("pareto_front").create_index("study_id", unique=True)
+        self._collection("study_directory").create_index("study_id", unique=True)
+        self._collection("study_directory").create_index("study_name", unique=True)
+        self._collection("meta").update_one(
+            {"_id": "schema"}, {"$max": {"version": SCHEMA_VERSION}}, upsert=True
+        )
+        self._schema_ready = True
+
+    # counter collection
+    # {
+    #   "_id": name of counter  string
+    #   "value": next value int
+    #  }
+    def _next_id(self, name: str, n: int = 1) -> int:
+        # Atomic allocation; the previous "max + 1" scan could hand out duplicated IDs.
+        # With n > 1, a block of n consecutive IDs is reserved and the first one returned.
+        doc = self._collection("counter", DURABILITY_SAFE).find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": n}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            session=self._session(),
+        )
+        return doc["value"] - n
 
     # Basic study manipulation
 
     # study collection
     # {
-    #   "name": name of study  string
+    #   "study_name": name of study  string
     #   "study_id": id of study int
+    #   "directions": StudyDirection values list
+    #   "user_attrs", "system_attrs": dict
+    #   "n_trials": number of created trials int
+    #   "n_finished": last reserved finish_seq, may run ahead of the finished trials int
+    #   "read_only": set once archiving starts, no trials can be added bool
+    #   "archived": set once the archive is complete bool
+    #   "archive_summary": n_trials, datetime_start and best_trial_id of the archive dict
     #  }
     def create_new_study(self, study_name: Optional[str] = None) -> int:
         """Create a new study from a name.
@@ -65,26 +583,47 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`optuna.exceptions.DuplicatedStudyError`:
                 If a study with the same ``study_name`` already exists.
         """
-        # TODO(ytsmiling) Fix RDB storage implementation to ensure unique `study_id`.
-        print("Create Study", study_name)
+        if study_name is None:
+            study_name = DEFAULT_STUDY_NAME_PREFIX + str(uuid.uuid4())
 
         # duplicate check
-        count = self.db.study.count_documents({"study_name": study_name})
+        count = self._collection("study").count_documents(
+            {"study_name": study_name}, session=self._session()
+        )
         if count != 0:
             raise optuna.exceptions.DuplicatedStudyError(study_name)
 
         # generate new study id
-        cur = self.db.study.find().sort("study_id", DESCENDING).limit(1)
-        new_id = -1
-        for doc in cur:
-            new_id = doc["study_id"]
-        new_id += 1
-        print( "new study id ", new_id)
-
-        self.db.study.insert_one({"study_id": new_id, "study_name": study_name})
-        print( "inserted id", new_id)
+        new_id = self._next_id("study_id")
+        self._insert_study(new_id, study_name)
         return new_id
 
+    def _insert_study(self, study_id: int, study_name: str) -> None:
+        # study IDs are never reused, so the counter can outgrow the trial ID layout
+        max_study_id = (1 << (63 - TRIAL_NUMBER_BITS - self._partition_bits)) - 1
+        if study_id > max_study_id:
+            raise RuntimeError(
+                "Study ID {} exceeds the largest study ID {} that trial IDs can encode.".format(
+                    study_id, max_study_id
+                )
+            )
+        try:
+            self._collection("study").insert_one(
+                {
+                    "study_id": study_id,
+                    "study_name": study_name,
+                    "directions": [StudyDirection.NOT_SET.value],
+                    "user_attrs": {},
+                    "system_attrs": {},
+                    "n_trials": 0,
+                },
+                session=self._session(),
+            )
+        except DuplicateKeyError:
+            # another worker created the same study after our duplicate check
+            raise optuna.exceptions.DuplicatedStudyError(study_name)
+        self._cache_study(study_id, study_name)
+
     def delete_study(self, study_id: int) -> None:
         """Delete a study.
         Args:
@@ -94,7 +633,160 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
+        # The study document goes first, so the study disappears at once and no trial can be
+        # added to it while its trials are removed batch by batch.
+        result = self._collection("study").delete_one(
+            {"study_id": study_id}, session=self._session()
+        )
+        if result.deleted_count == 0:
+            raise KeyError(study_id)
+
+        study_name = self._metadata.get(("name", study_id))
+        if study_name is not _MISSING:
+            self._metadata.pop(("id", study_name))
+        self._metadata.pop(("name", study_id))
+        self._metadata.pop(("directions", study_id))
+
+        for name in ("trial", "trial_bucket", "trial_archive"):
+            self._delete_in_batches(name, {"study_id": study_id})
+        self._collection("pareto_front").delete_one(
+            {"study_id": study_id}, session=self._session()
+        )
+
+        with self._observations_lock:
+            for key in [k for k in self._observations if k[0] == study_id]:
+                del self._observations[key]
+
+    def _delete_in_batches(self, name: str, query: Dict[str, Any]) -> None:
+        collection = self._collection(name, DURABILITY_SAFE)
+        session = self._session()
+        while True:
+            ids = [
+                doc["_id"]
+                for doc in collection.find(
+                    query, projection={"_id": 1}, limit=DELETE_BATCH_SIZE, session=session
+                )
+            ]
+            if len(ids) == 0:
+                break
+            collection.delete_many({"_id": {"$in": ids}}, session=session)
+
+    def archive_study(self, study_id: int, chunk_size: int = 1000) -> None:
+        """Compact the trials of a finished study into the archive collection.
+
+        The trials are packed into zlib-compressed ``trial_archive`` documents of
+        ``chunk_size`` trials each and removed from the ``trial`` and ``trial_bucket``
+        collections and their indexes. Archived trials are still returned by
+        :meth:`get_trial` and :meth:`get_all_trials`, but can not be updated.
+        Args:
+            study_id:
+                ID of the study.
+            chunk_size:
+                Number of trials per archive document.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+            :exc:`RuntimeError`:
+                If the study has unfinished trials.
+        """
+        session = self._session()
+        # No trial can be created from here on, so every trial read below stays finished.
+        study = self._collection("study").find_one_and_update(
+            {"study_id": study_id},
+            {"$set": {"read_only": True}},
+            projection={"directions": 1, "archived": 1},
+            session=session,
+        )
+        if study is None:
+            raise KeyError(study_id)
+        if not study.get("archived", False):
+            try:
+                self._write_archive(study_id, study, chunk_size)
+            except RuntimeError:
+                self._collection("study").update_one(
+                    {"study_id": study_id}, {"$unset": {"read_only": ""}}, session=session
+                )
+                raise
+
+        # the hot copies are removed only once the archive is complete, and only the ones
+        # the archive holds
+        last_chunk = self._collection("trial_archive").find_one(
+            {"study_id": study_id},
+            projection={"max_number": 1},
+            sort=[("max_number", DESCENDING)],
+            session=session,
+        )
+        if last_chunk is None:
+            return
+        archived = {"$lte": last_chunk["max_number"]}
+        self._delete_in_batches("trial", {"study_id": study_id, "number": archived})
+        self._delete_in_batches("trial_bucket", {"study_id": study_id, "max_number": archived})
+
+    def _write_archive(self, study_id: int, study: Dict[str, Any], chunk_size: int) -> None:
+        session = self._session()
+        # Hot trials up to the archived numbers are deleted afterwards, so a lagging secondary
+        # must not be read here.
+        trial_docs = self._find_trial_docs(study_id, bulk=False)
+        for trial_doc in trial_docs:
+            if not TrialState(trial_doc["state"]).is_finished():
+                raise RuntimeError(
+                    "Trial#{} is not finished and can not be archived.".format(trial_doc["number"])
+                )
+
+        for i in range(0, len(trial_docs), chunk_size):
+            chunk = [
+                {k: v for k, v in t.items() if k != "_id"} for t in trial_docs[i : i + chunk_size]
+            ]
+            self._collection("trial_archive").update_one(
+                {"study_id": study_id, "chunk": i // chunk_size},
+                {
+                    "$set": {
+                        "min_number": chunk[0]["number"],
+                        "max_number": chunk[-1]["number"],
+                        "count": len(chunk),
+                        "max_finish_seq": max(t.get("finish_seq", 0) for t in chunk),
+                        "data": bson.Binary(zlib.compress(bson.encode({"trials": chunk}))),
+                    }
+                },
+                upsert=True,
+                session=session,
+            )
+
+        # keep what study summaries need, so they don't have to decompress the archive
+        directions = self._deserialize_directions(study["directions"])
+        best_trial = None
+        if len(directions) == 1 and directions[0] != StudyDirection.NOT_SET:
+            complete = [t for t in trial_docs if t["state"] == TrialState.COMPLETE.value]
+            if len(complete) > 0:
+                best = max if directions[0] == StudyDirection.MAXIMIZE else min
+                best_trial = best(complete, key=lambda t: t["values"][0])["trial_id"]
+        starts = [t["datetime_start"] for t in trial_docs if t["datetime_start"] is not None]
+        self._collection("study").update_one(
+            {"study_id": study_id},
+            {
+                "$set": {
+                    "archived": True,
+                    "archive_summary": {
+                        "n_trials": len(trial_docs),
+                        "datetime_start": min(starts) if len(starts) > 0 else None,
+                        "best_trial_id": best_trial,
+                    },
+                }
+            },
+            session=session,
+        )
+
+    # trial_archive collection
+    # {
+    #   "study_id": id of study int
+    #   "chunk": index of chunk int
+    #   "min_number", "max_number": range of trial numbers in the chunk int
+    #   "count": number of trials in the chunk int
+    #   "max_finish_seq": largest finish_seq in the chunk int
+    #   "data": zlib compressed BSON {"trials": trial documents list}
+    #  }
+    def _decode_archive_chunk(self, chunk: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return bson.decode(zlib.decompress(chunk["data"]))["trials"]
 
     def set_study_user_attr(self, study_id: int, key: str, value: Any) -> None:
         """Register a user-defined attribute to a study.
@@ -110,7 +802,13 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
+        result = self._collection("study").update_one(
+            {"study_id": study_id},
+            {"$set": {"user_attrs." + key: value}},
+            session=self._session(),
+        )
+        if result.matched_count == 0:
+            raise KeyError(study_id)
 
     def set_study_system_attr(self, study_id: int, key: str, value: Any) -> None:
         """Register an optuna-internal attribute to a study.
@@ -126,7 +824,13 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
+        result = self._collection("study").update_one(
+            {"study_id": study_id},
+            {"$set": {"system_attrs." + key: value}},
+            session=self._session(),
+        )
+        if result.matched_count == 0:
+            raise KeyError(study_id)
 
 
 
@@ -146,13 +850,12 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
                 If the directions are already set and the each coordinate of passed ``directions``
                 is the opposite direction or :obj:`~optuna.study.StudyDirection.NOT_SET`.
         """
-        print("set_study_directions", directions)
         # existance check
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
+        study = self._collection("study").find_one({"study_id": study_id}, session=self._session())
+        if study is None:
             raise KeyError(study_id)
         
-        # check all directions are NOT_SET or opposite        
+        # check all directions are NOT_SET
         all_not_set = True
         for d in directions:
             if d != StudyDirection.NOT_SET:
@@ -161,19 +864,21 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
         if all_not_set:
             raise ValueError("All directions are NOT_SET")
 
-
-        # if all directions are not opposite, then update directions
+        # directions can be changed only while they are NOT_SET
         serialized_directions = self._serialize_directions(directions)
-        study = self.db.study.find_one({"study_id": study_id})
-        if "directions" in study:
-            opposite = True
-            for d,e in zip(serialized_directions, study["directions"]):
-                if d + e != StudyDirection.MAXIMIZE + StudyDirection.MINIMIZE:
-                    opposite = False
-                    break
-            if opposite == True:
-                raise ValueError("All directions are opposite")
-        self.db.study.update_one({"study_id": study_id}, {"$set": {"directions": serialized_directions}})
+        current = study.get("directions", [StudyDirection.NOT_SET.value])
+        if any(d != StudyDirection.NOT_SET.value for d in current) and current != serialized_directions:
+            raise ValueError(
+                "Cannot overwrite study direction from {} to {}.".format(
+                    self._deserialize_directions(current), directions
+                )
+            )
+        self._collection("study").update_one(
+            {"study_id": study_id},
+            {"$set": {"directions": serialized_directions}},
+            session=self._session(),
+        )
+        self._cache_directions(study_id, serialized_directions)
 
 
     # Basic study access
@@ -189,13 +894,20 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
                 If no study with the matching ``study_name`` exists.
         """
 
-        # existance check
-        count = self.db.study.count_documents({"study_name": study_name})
-        if count == 0:
+        study_id = self._metadata.get(("id", study_name))
+        if study_id is None:
             raise KeyError(study_name)
-        
-        study_id = self.db.study.find_one({"study_name": study_name})["study_id"]
-        return study_id
+        if study_id is not _MISSING:
+            return study_id
+
+        study = self._collection("study").find_one(
+            {"study_name": study_name}, projection={"study_id": 1}, session=self._session()
+        )
+        if study is None:
+            self._metadata.put_negative(("id", study_name))
+            raise KeyError(study_name)
+        self._cache_study(study["study_id"], study_name)
+        return study["study_id"]
 
 
     def get_study_id_from_trial_id(self, trial_id: int) -> int:
@@ -207,9 +919,22 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             ID of the study.
         Raises:
             :exc:`KeyError`:
-                If no trial with the matching ``trial_id`` exists.
-        """        
-        raise NotImplementedError
+                If ``trial_id`` is not a valid trial ID of this storage.
+                As the study is decoded from the ID, the trial itself is not looked up.
+        """
+        return self._decode_trial_id(trial_id)[0]
+
+    def _encode_trial_id(self, study_id: int, number: int) -> int:
+        if number >= (1 << TRIAL_NUMBER_BITS):
+            raise ValueError("A study can hold at most {} trials.".format(1 << TRIAL_NUMBER_BITS))
+        local_id = (study_id << TRIAL_NUMBER_BITS) | number
+        return (local_id << self._partition_bits) | self._partition
+
+    def _decode_trial_id(self, trial_id: int) -> Tuple[int, int]:
+        if trial_id < 0 or trial_id & ((1 << self._partition_bits) - 1) != self._partition:
+            raise KeyError(trial_id)
+        local_id = trial_id >> self._partition_bits
+        return local_id >> TRIAL_NUMBER_BITS, local_id & ((1 << TRIAL_NUMBER_BITS) - 1)
 
     def get_study_name_from_id(self, study_id: int) -> str:
         """Read the study name of a study.
@@ -222,13 +947,20 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        # existance check
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
+        study_name = self._metadata.get(("name", study_id))
+        if study_name is None:
             raise KeyError(study_id)
-
-        study_name = self.db.study.find_one({"study_id": study_id})["study_name"]
-        return study_name
+        if study_name is not _MISSING:
+            return study_name
+
+        study = self._collection("study").find_one(
+            {"study_id": study_id}, projection={"study_name": 1}, session=self._session()
+        )
+        if study is None:
+            self._metadata.put_negative(("name", study_id))
+            raise KeyError(study_id)
+        self._cache_study(study_id, study["study_name"])
+        return study["study_name"]
 
     def get_study_directions(self, study_id: int) -> List[StudyDirection]:
         """Read whether a study maximizes or minimizes an objective.
@@ -241,16 +973,11 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
-
-
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
-            raise KeyError(study_id)
-
-        serialized_directions = self.db.study.find_one({"study_id": study_id})["directions"]
-        directions = self._deserialize_directions(serialized_directions)
-        return directions
+        serialized_directions = self._metadata.get(("directions", study_id))
+        if serialized_directions is _MISSING:
+            serialized_directions = self._get_study_field(study_id, "directions")
+            self._cache_directions(study_id, serialized_directions)
+        return self._deserialize_directions(serialized_directions)
 
 
     def get_study_user_attrs(self, study_id: int) -> Dict[str, Any]:
@@ -264,13 +991,7 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
-
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
-            raise KeyError(study_id)
-
-        return self.db.study.find_one({"study_id": study_id})["user_attrs"]
+        return self._get_study_field(study_id, "user_attrs")
 
 
     def get_study_system_attrs(self, study_id: int) -> Dict[str, Any]:
@@ -284,13 +1005,46 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        raise NotImplementedError
+        return self._get_study_field(study_id, "system_attrs")
 
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
+    def _get_study_field(self, study_id: int, field: str) -> Any:
+        study = self._collection("study").find_one(
+            {"study_id": study_id}, projection={field: 1}, session=self._session()
+        )
+        if study is None:
             raise KeyError(study_id)
+        return study[field]
 
-        return self.db.study.find_one({"study_id": study_id})["system_attrs"]
+    def get_all_studies(self) -> List[FrozenStudy]:
+        """Read a list of :class:`~optuna.study.FrozenStudy` objects.
+        Returns:
+            A list of :class:`~optuna.study.FrozenStudy` objects.
+        """
+        cursor = self._collection("study", bulk=True).find(
+            projection={
+                "study_id": 1,
+                "study_name": 1,
+                "directions": 1,
+                "user_attrs": 1,
+                "system_attrs": 1,
+            },
+            sort=[("study_id", ASCENDING)],
+            session=self._session(),
+        )
+        studies = []
+        for study in cursor:
+            directions = self._deserialize_directions(study["directions"])
+            studies.append(
+                FrozenStudy(
+                    study_name=study["study_name"],
+                    direction=None,
+                    directions=directions,
+                    user_attrs=study["user_attrs"],
+                    system_attrs=study["system_attrs"],
+                    study_id=study["study_id"],
+                )
+            )
+        return studies
 
     def get_all_study_summaries(self, include_best_trial: bool) -> List[StudySummary]:
         """Read a list of :class:`~optuna.study.StudySummary` objects.
@@ -301,7 +1055,105 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
         Returns:
             A list of :class:`~optuna.study.StudySummary` objects.
         """
-        raise NotImplementedError
+        session = self._session()
+        study_collection = self._collection("study", bulk=True)
+        trial_collection = self._collection("trial", bulk=True)
+
+        stats: Dict[int, Dict[str, Any]] = {}
+        pipelines = [
+            (
+                trial_collection,
+                {
+                    "_id": "$study_id",
+                    "n_trials": {"$sum": 1},
+                    "datetime_start": {"$min": "$datetime_start"},
+                },
+            )
+        ]
+        if self._bucket_size is not None:
+            pipelines.append(
+                (
+                    self._collection("trial_bucket", bulk=True),
+                    {
+                        "_id": "$study_id",
+                        "n_trials": {"$sum": "$count"},
+                        "datetime_start": {"$min": {"$min": "$trials.datetime_start"}},
+                    },
+                )
+            )
+        for collection, group in pipelines:
+            for doc in collection.aggregate([{"$group": group}], session=session):
+                study_stats = stats.setdefault(doc["_id"], {"n_trials": 0, "datetime_start": None})
+                study_stats["n_trials"] += doc["n_trials"]
+                if doc["datetime_start"] is not None and (
+                    study_stats["datetime_start"] is None
+                    or doc["datetime_start"] < study_stats["datetime_start"]
+                ):
+                    study_stats["datetime_start"] = doc["datetime_start"]
+
+        summaries = []
+        for study in study_collection.find(session=session).sort("study_id", ASCENDING):
+            study_id = study["study_id"]
+            directions = self._deserialize_directions(study["directions"])
+            study_stats = stats.get(study_id, {})
+
+            best_trial = None
+            if study.get("archived", False):
+                study_stats = study["archive_summary"]
+                if include_best_trial and study_stats["best_trial_id"] is not None:
+                    best_trial = self.get_trial(study_stats["best_trial_id"])
+            elif include_best_trial and len(directions) == 1:
+                best_doc = self._find_best_trial_doc(study_id, directions[0])
+                if best_doc is not None:
+                    best_trial = self._deserialize_trial(best_doc)
+
+            summaries.append(
+                StudySummary(
+                    study_name=study["study_name"],
+                    direction=directions[0] if len(directions) == 1 else None,
+                    best_trial=best_trial,
+                    user_attrs=study["user_attrs"],
+                    system_attrs=study["system_attrs"],
+                    n_trials=study_stats.get("n_trials", 0),
+                    datetime_start=study_stats.get("datetime_start"),
+                    study_id=study_id,
+                    directions=directions,
+                )
+            )
+        return summaries
+
+    def _find_best_trial_doc(
+        self, study_id: int, direction: StudyDirection
+    ) -> Optional[Dict[str, Any]]:
+        session = self._session()
+        order = DESCENDING if direction == StudyDirection.MAXIMIZE else ASCENDING
+        complete = TrialState.COMPLETE.value
+
+        candidates = []
+        best_doc = self._collection("trial", bulk=True).find_one(
+            {"study_id": study_id, "state": complete},
+            sort=[("values.0", order)],
+            session=session,
+        )
+        if best_doc is not None:
+            candidates.append(best_doc)
+        if self._bucket_size is not None:
+            pipeline = [
+                {"$match": {"study_id": study_id, "states." + str(complete): {"$gt": 0}}},
+                {"$unwind": "$trials"},
+                {"$replaceRoot": {"newRoot": "$trials"}},
+                {"$match": {"state": complete}},
+                {"$sort": {"values.0": order}},
+                {"$limit": 1},
+            ]
+            candidates.extend(
+                self._collection("trial_bucket", bulk=True).aggregate(pipeline, session=session)
+            )
+
+        if len(candidates) == 0:
+            return None
+        best = max if direction == StudyDirection.MAXIMIZE else min
+        return best(candidates, key=lambda t: t["values"][0])
 
     # Basic trial manipulation
 
@@ -319,136 +1171,275 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
         Raises:
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
+            :exc:`RuntimeError`:
+                If the study is archived.
         """
 
-        if template_trial is not None:
-            print("template trial is supported.")
-            raise NotImplementedError
-
-        # existance check
-        count = self.db.study.count_documents({"study_id": study_id})
-        if count == 0:
-            raise KeyError(study_id)
-
-        # generate new trial id
-        cur = self.db.trial.find().sort("trial_id", DESCENDING).limit(1)
-        new_id = -1
-        for doc in cur:
-            new_id = doc["trial_id"]
-        new_id += 1
-        print( "new trial id ", new_id)
-
-        trial = self._create_new_trial(study_id,template_trial)
-        self.db.trial.insert_one({"study_id": study_id, "trial_id": new_id})
-        return new_id
+        number = self._reserve_numbers(study_id, 1)
 
+        new_id = self._encode_trial_id(study_id, number)
 
-    def _get_prepared_new_trial(
-        self, study_id: int, template_trial: Optional[FrozenTrial]
-    ) -> Trial:
         if template_trial is None:
-            trial = Trial(
-                study_id=study_id,
-                number=None,
+            trial = FrozenTrial(
+                number=number,
                 state=TrialState.RUNNING,
-                datetime_start=datetime.now(),
-            )
-        else:
-            # Because only `RUNNING` trials can be updated,
-            # we temporarily set the state of the new trial to `RUNNING`.
-            # After all fields of the trial have been updated,
-            # the state is set to `template_trial.state`.
-            temp_state = TrialState.RUNNING
-
-            trial = Trial(
-                study_id=study_id,
-                number=None,
-                state=temp_state,
-                datetime_start=template_trial.datetime_start,
-                datetime_complete=template_trial.datetime_complete,
-            )
-
-            if template_trial.values is not None and len(template_trial.values) > 1:
-                for objective, value in enumerate(template_trial.values):
-                    self._set_trial_value_without_commit(session, trial.trial_id, objective, value)
-            elif template_trial.value is not None:
-                self._set_trial_value_without_commit(
-                    session, trial.trial_id, 0, template_trial.value
-                )
-
-            for param_name, param_value in template_trial.params.items():
-                distribution = template_trial.distributions[param_name]
-                param_value_in_internal_repr = distribution.to_internal_repr(param_value)
-                self._set_trial_param_without_commit(
-                    session, trial.trial_id, param_name, param_value_in_internal_repr, distribution
-                )
-
-            for key, value in template_trial.user_attrs.items():
-                self._set_trial_user_attr_without_commit(session, trial.trial_id, key, value)
-
-            for key, value in template_trial.system_attrs.items():
-                self._set_trial_system_attr_without_commit(session, trial.trial_id, key, value)
-
-            for step, intermediate_value in template_trial.intermediate_values.items():
-                self._set_trial_intermediate_value_without_commit(
-                    session, trial.trial_id, step, intermediate_value
-                )
-
-            trial.state = template_trial.state
-
-        trial.number = trial.count_past_trials(session)
-        session.add(trial)
-
-        return trial
-
-
-
-    def _create_new_trial(
-        self, study_id: int, template_trial: Optional[FrozenTrial] = None
-    ) -> FrozenTrial:
-        """Create a new trial and returns its trial_id and a :class:`~optuna.trial.FrozenTrial`.
-
-        Args:
-            study_id:
-                Study id.
-            template_trial:
-                A :class:`~optuna.trial.FrozenTrial` with default values for trial attributes.
-
-        Returns:
-            A :class:`~optuna.trial.FrozenTrial` instance.
-
-        """
-        trial_obj = self._get_prepared_new_trial(study_id, template_trial)
-
-        if template_trial:
-            frozen = copy.deepcopy(template_trial)
-            frozen.number = trial.number
-            frozen.datetime_start = trial.datetime_start
-            frozen._trial_id = trial.trial_id
-        else:
-            frozen = FrozenTrial(
-                number=trial.number,
-                state=trial.state,
                 value=None,
                 values=None,
-                datetime_start=trial.datetime_start,
+                datetime_start=datetime.datetime.now(),
                 datetime_complete=None,
                 params={},
                 distributions={},
                 user_attrs={},
                 system_attrs={},
                 intermediate_values={},
-                trial_id=trial.trial_id,
+                trial_id=new_id,
             )
+        else:
+            trial = copy.deepcopy(template_trial)
+            trial.number = number
+            trial._trial_id = new_id
+
+        trial_doc = self._serialize_trial(study_id, trial)
+        if trial.state.is_finished():
+            directions = self._register_finished(trial_doc)
+        if self._bucket_size is not None and trial.state.is_finished():
+            self._push_to_bucket(trial_doc)
+        else:
+            self._collection("trial").insert_one(trial_doc, session=self._session())
+        if trial.state.is_finished():
+            self._update_pareto_front(trial_doc, directions)
+        return new_id
 
-        return frozen
-
-
+    def _reserve_numbers(self, study_id: int, n: int) -> int:
+        # allocate the trial numbers and check existance at once
+        study = self._collection("study").find_one_and_update(
+            {"study_id": study_id, "read_only": {"$ne": True}},
+            {"$inc": {"n_trials": n}},
+            projection={"n_trials": 1},
+            return_document=ReturnDocument.AFTER,
+            session=self._session(),
+        )
+        if study is None:
+            if self._collection("study").count_documents(
+                {"study_id": study_id}, limit=1, session=self._session()
+            ) == 0:
+                raise KeyError(study_id)
+            raise RuntimeError(
+                "Study with study_id {} is archived and can not be updated.".format(study_id)
+            )
+        return study["n_trials"] - n
 
+    def _insert_trial_docs(
+        self, study_id: int, trial_docs: List[Dict[str, Any]], first_number: int
+    ) -> List[Dict[str, Any]]:
+        """Insert serialized trials in bulk, as done by :mod:`optuna_mongo_storage.migration`.
 
+        ``trial_docs`` are :meth:`_serialize_trial` documents whose numbers are assigned from
+        ``first_number`` on, which must have been reserved with :meth:`_reserve_numbers`.
+        Finish sequence numbers are reserved as a block, and the documents are written
+        with unordered bulk writes. The inserted documents are returned.
+        """
+        session = self._session()
+        finished = [t for t in trial_docs if TrialState(t["state"]).is_finished()]
+        if len(finished) > 0:
+            first_seq, _ = self._reserve_finish_seqs(study_id, len(finished))
+            for i, trial_doc in enumerate(finished):
+                trial_doc["finish_seq"] = first_seq + i
+
+        for i, trial_doc in enumerate(trial_docs):
+            trial_doc["study_id"] = study_id
+            trial_doc["number"] = first_number + i
+            trial_doc["trial_id"] = self._encode_trial_id(study_id, first_number + i)
+
+        if self._bucket_size is None:
+            hot = trial_docs
+        else:
+            hot = [t for t in trial_docs if not TrialState(t["state"]).is_finished()]
+            buckets: Dict[int, List[Dict[str, Any]]] = {}
+            for trial_doc in finished:
+                buckets.setdefault(trial_doc["number"] // self._bucket_size, []).append(trial_doc)
+            requests = []
+            for bucket, docs in buckets.items():
+                states: Dict[str, int] = {}
+                for trial_doc in docs:
+                    key = "states." + str(trial_doc["state"])
+                    states[key] = states.get(key, 0) + 1
+                requests.append(
+                    UpdateOne(
+                        {"study_id": study_id, "bucket": bucket},
+                        {
+                            "$push": {"trials": {"$each": docs}},
+                            "$min": {"min_number": docs[0]["number"]},
+                            "$max": {
+                                "max_number": docs[-1]["number"],
+                                "max_finish_seq": max(t["finish_seq"] for t in docs),
+                            },
+                            "$inc": dict(states, count=len(docs)),
+                        },
+                        upsert=True,
+                    )
+                )
+            if len(requests) > 0:
+                self._collection("trial_bucket").bulk_write(
+                    requests, ordered=False, session=session
+                )
+        if len(hot) > 0:
+            self._collection("trial").insert_many(hot, ordered=False, session=session)
+        return trial_docs
 
+    # trial_bucket collection
+    # {
+    #   "study_id": id of study int
+    #   "bucket": number // bucket_size int
+    #   "min_number", "max_number": range of trial numbers in the bucket int
+    #   "count": number of trials in the bucket int
+    #   "states": str(TrialState value) -> number of trials in the state
+    #   "max_finish_seq": largest finish_seq in the bucket int
+    #   "trials": finished trial documents list
+    #  }
+    def _push_to_bucket(self, trial_doc: Dict[str, Any]) -> None:
+        trial_doc = {k: v for k, v in trial_doc.items() if k != "_id"}
+        number = trial_doc["number"]
+        bucket_filter = {
+            "study_id": trial_doc["study_id"],
+            "bucket": number // self._bucket_size,
+            "trials.trial_id": {"$ne": trial_doc["trial_id"]},
+        }
+        update = {
+            "$push": {"trials": trial_doc},
+            "$min": {"min_number": number},
+            "$max": {
+                "max_number": number,
+                "max_finish_seq": trial_doc.get("finish_seq", 0),
+            },
+            "$inc": {"count": 1, "states." + str(trial_doc["state"]): 1},
+        }
+        try:
+            self._collection("trial_bucket").update_one(
+                bucket_filter, update, upsert=True, session=self._session()
+            )
+        except DuplicateKeyError:
+            # Either the bucket already holds this trial, or another worker created the
+            # bucket after our filter matched nothing. The server does not retry such an
+            # upsert because of the $ne condition, so push into the existing bucket. No match
+            # means the trial is already there.
+            self._collection("trial_bucket").update_one(
+                bucket_filter, update, session=self._session()
+            )
 
+    def _move_to_bucket(self, trial_doc: Dict[str, Any]) -> None:
+        # Push first, then delete, so that the trial is always visible somewhere.
+        # Readers deduplicate by trial_id.
+        self._push_to_bucket(trial_doc)
+        self._collection("trial").delete_one(
+            {"trial_id": trial_doc["trial_id"]}, session=self._session()
+        )
+
+    def _find_trial_doc(
+        self, trial_id: int, projection: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        try:
+            study_id, number = self._decode_trial_id(trial_id)
+        except KeyError:
+            return None
+        trial_doc = self._collection("trial").find_one(
+            {"trial_id": trial_id}, projection=projection, session=self._session()
+        )
+        if trial_doc is None and self._bucket_size is not None:
+            bucket = self._collection("trial_bucket").find_one(
+                {"study_id": study_id, "bucket": number // self._bucket_size},
+                projection={"trials": {"$elemMatch": {"trial_id": trial_id}}},
+                session=self._session(),
+            )
+            if bucket is not None and len(bucket.get("trials", [])) > 0:
+                trial_doc = bucket["trials"][0]
+        if trial_doc is None:
+            chunk = self._collection("trial_archive").find_one(
+                {
+                    "study_id": study_id,
+                    "min_number": {"$lte": number},
+                    "max_number": {"$gte": number},
+                },
+                session=self._session(),
+            )
+            if chunk is not None:
+                for archived in self._decode_archive_chunk(chunk):
+                    if archived["trial_id"] == trial_id:
+                        trial_doc = archived
+        return trial_doc
 
+    def _find_trial_docs(
+        self,
+        study_id: int,
+        states: Optional[List[int]] = None,
+        archived: bool = False,
+        numbers: Optional[Tuple[int, int]] = None,
+        bulk: bool = True,
+    ) -> List[Dict[str, Any]]:
+        # numbers is a half-open range of trial numbers; buckets and archive chunks outside of
+        # it are skipped by their min/max number. bulk=False reads from the primary.
+        session = self._session()
+
+        def selected(trial_doc: Dict[str, Any]) -> bool:
+            if states is not None and trial_doc["state"] not in states:
+                return False
+            return numbers is None or numbers[0] <= trial_doc["number"] < numbers[1]
+
+        range_filter: Dict[str, Any] = {}
+        if numbers is not None:
+            range_filter = {"max_number": {"$gte": numbers[0]}, "min_number": {"$lt": numbers[1]}}
+
+        trial_docs = {}
+        if archived:
+            cursor = self._collection("trial_archive", bulk=bulk).find(
+                dict(range_filter, study_id=study_id), session=session
+            )
+            for chunk in cursor:
+                for trial_doc in self._decode_archive_chunk(chunk):
+                    if selected(trial_doc):
+                        trial_docs[trial_doc["trial_id"]] = trial_doc
+
+        trial_filter: Dict[str, Any] = {"study_id": study_id}
+        if states is not None:
+            trial_filter["state"] = {"$in": states}
+        if numbers is not None:
+            trial_filter["number"] = {"$gte": numbers[0], "$lt": numbers[1]}
+
+        for trial_doc in self._collection("trial", bulk=bulk).find(trial_filter, session=session):
+            trial_docs[trial_doc["trial_id"]] = trial_doc
+
+        if self._bucket_size is not None:
+            bucket_filter: Dict[str, Any] = dict(range_filter, study_id=study_id)
+            if states is not None:
+                # skip buckets without any trial in the requested states
+                bucket_filter["$or"] = [{"states." + str(s): {"$gt": 0}} for s in states]
+            cursor = self._collection("trial_bucket", bulk=bulk).find(
+                bucket_filter, projection={"trials": 1}, session=session
+            )
+            for bucket in cursor:
+                for trial_doc in bucket["trials"]:
+                    if selected(trial_doc):
+                        trial_docs[trial_doc["trial_id"]] = trial_doc
+
+        return sorted(trial_docs.values(), key=lambda t: t["number"])
+
+    def _update_trial(self, trial_id: int, update: Dict[str, Any], profile: str) -> None:
+        # The state guard makes the "already finished" check and the write a single operation.
+        result = self._collection("trial", profile).update_one(
+            {"trial_id": trial_id, "state": {"$in": _UPDATABLE_STATES}},
+            update,
+            session=self._session(),
+        )
+        if result.acknowledged and result.matched_count == 0:
+            self._raise_not_updatable(trial_id)
+
+    def _raise_not_updatable(self, trial_id: int) -> None:
+        trial_doc = self._find_trial_doc(trial_id)
+        if trial_doc is None:
+            raise KeyError(trial_id)
+        raise RuntimeError(
+            "Trial#{} has already finished and can not be updated.".format(trial_doc["number"])
+        )
 
     def set_trial_param(
         self,
@@ -473,7 +1464,16 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`RuntimeError`:
                 If the trial is already finished.
         """
-        raise NotImplementedError
+        self._update_trial(
+            trial_id,
+            {
+                "$set": {
+                    "params." + param_name: param_value_internal,
+                    "distributions." + param_name: distribution_to_json(distribution),
+                }
+            },
+            DURABILITY_SAFE,
+        )
 
     def get_trial_id_from_study_id_trial_number(self, study_id: int, trial_number: int) -> int:
         """Read the trial ID of a trial.
@@ -488,7 +1488,16 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no trial with the matching ``study_id`` and ``trial_number`` exists.
         """
-        raise NotImplementedError
+        study = self._collection("study").find_one(
+            {"study_id": study_id}, projection={"n_trials": 1}, session=self._session()
+        )
+        if study is None or not 0 <= trial_number < study.get("n_trials", 0):
+            raise KeyError(
+                "No trial with trial number {} exists in study with study_id {}.".format(
+                    trial_number, study_id
+                )
+            )
+        return self._encode_trial_id(study_id, trial_number)
 
     def get_trial_number_from_id(self, trial_id: int) -> int:
         """Read the trial number of a trial.
@@ -501,9 +1510,10 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             Number of the trial.
         Raises:
             :exc:`KeyError`:
-                If no trial with the matching ``trial_id`` exists.
+                If ``trial_id`` is not a valid trial ID of this storage.
+                As the number is decoded from the ID, the trial itself is not looked up.
         """
-        return self.get_trial(trial_id).number
+        return self._decode_trial_id(trial_id)[1]
 
     def get_trial_param(self, trial_id: int, param_name: str) -> float:
         """Read the parameter of a trial.
@@ -547,7 +1557,120 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`RuntimeError`:
                 If the trial is already finished.
         """
-        raise NotImplementedError
+        update: Dict[str, Any] = {"state": state.value}
+        if values is not None:
+            update["values"] = list(values)
+
+        trial_filter: Dict[str, Any] = {"trial_id": trial_id}
+        if state == TrialState.RUNNING:
+            # only a WAITING trial can be started
+            trial_filter["state"] = TrialState.WAITING.value
+            update["datetime_start"] = datetime.datetime.now()
+        else:
+            trial_filter["state"] = {"$in": _UPDATABLE_STATES}
+        if state.is_finished():
+            update["datetime_complete"] = datetime.datetime.now()
+            # A finished trial can not be updated, so a rejected transition is caught
+            # before it reserves a sequence number.
+            if self._collection("trial").find_one(
+                trial_filter, projection={"_id": 1}, session=self._session()
+            ) is None:
+                self._raise_not_updatable(trial_id)
+            # The sequence number is reserved first, so that it is written with the state.
+            # Only a concurrent finish of the same trial can still leave a hole,
+            # which readers skip after a timeout.
+            update["finish_seq"], directions = self._reserve_finish_seqs(
+                self._decode_trial_id(trial_id)[0], 1
+            )
+
+        trial_doc = self._collection("trial", DURABILITY_SAFE).find_one_and_update(
+            trial_filter,
+            {"$set": update},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=self._session(),
+        )
+        if trial_doc is None:
+            trial_doc = self._find_trial_doc(trial_id, projection={"state": 1})
+            if (
+                state == TrialState.RUNNING
+                and trial_doc is not None
+                and trial_doc["state"] == TrialState.RUNNING.value
+            ):
+                return False
+            self._raise_not_updatable(trial_id)
+
+        if state.is_finished():
+            if self._bucket_size is not None:
+                self._move_to_bucket(trial_doc)
+            self._update_pareto_front(trial_doc, directions)
+        return True
+
+    def _register_finished(self, trial_doc: Dict[str, Any]) -> List[int]:
+        first_seq, directions = self._reserve_finish_seqs(trial_doc["study_id"], 1)
+        trial_doc["finish_seq"] = first_seq
+        return directions
+
+    def _reserve_finish_seqs(self, study_id: int, n: int) -> Tuple[int, List[int]]:
+        # Dense per-study sequence of finished trials, used to fetch only new observations.
+        # The study's n_finished is the last reserved number, not a count of finished trials.
+        # The study's directions come back in the same round trip for the Pareto front.
+        study = self._collection("study").find_one_and_update(
+            {"study_id": study_id},
+            {"$inc": {"n_finished": n}},
+            projection={"n_finished": 1, "directions": 1},
+            return_document=ReturnDocument.AFTER,
+            session=self._session(),
+        )
+        if study is None:
+            raise KeyError(study_id)
+        return study["n_finished"] - n + 1, study["directions"]
+
+    # pareto_front collection
+    # {
+    #   "study_id": id of study int
+    #   "version": number of updates, for optimistic concurrency int
+    #   "front": non-dominated trials list of {"trial_id": int, "values": list}
+    #  }
+    def _update_pareto_front(self, trial_doc: Dict[str, Any], directions: List[int]) -> None:
+        # only multi-objective studies keep a front
+        if len(directions) < 2 or trial_doc["state"] != TrialState.COMPLETE.value:
+            return
+        if trial_doc["values"] is None:
+            return
+        entry = {"trial_id": trial_doc["trial_id"], "values": trial_doc["values"]}
+        self._merge_pareto_front(trial_doc["study_id"], [entry], directions)
+
+    def _merge_pareto_front(
+        self, study_id: int, entries: List[Dict[str, Any]], directions: List[int]
+    ) -> None:
+        collection = self._collection("pareto_front")
+        session = self._session()
+        while True:
+            doc = collection.find_one({"study_id": study_id}, session=session)
+            front = doc["front"] if doc is not None else []
+            new_front = _merge_front(front, entries, directions)
+            if doc is not None and len(new_front) == len(front):
+                if [e["trial_id"] for e in new_front] == [e["trial_id"] for e in front]:
+                    return
+
+            if doc is None:
+                try:
+                    collection.insert_one(
+                        {"study_id": study_id, "version": 1, "front": new_front},
+                        session=session,
+                    )
+                    return
+                except DuplicateKeyError:
+                    continue
+            result = collection.update_one(
+                {"study_id": study_id, "version": doc["version"]},
+                {"$set": {"front": new_front}, "$inc": {"version": 1}},
+                session=session,
+            )
+            if result.matched_count == 1:
+                return
+            # another worker updated the front in the meantime
 
     def set_trial_intermediate_value(
         self, trial_id: int, step: int, intermediate_value: float
@@ -567,7 +1690,11 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`RuntimeError`:
                 If the trial is already finished.
         """
-        raise NotImplementedError
+        self._update_trial(
+            trial_id,
+            {"$set": {"intermediate_values." + str(step): intermediate_value}},
+            DURABILITY_FAST,
+        )
 
     def set_trial_user_attr(self, trial_id: int, key: str, value: Any) -> None:
         """Set a user-defined attribute to a trial.
@@ -585,7 +1712,7 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`RuntimeError`:
                 If the trial is already finished.
         """
-        raise NotImplementedError
+        self._update_trial(trial_id, {"$set": {"user_attrs." + key: value}}, DURABILITY_FAST)
 
     def set_trial_system_attr(self, trial_id: int, key: str, value: Any) -> None:
         """Set an optuna-internal attribute to a trial.
@@ -603,7 +1730,8 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`RuntimeError`:
                 If the trial is already finished.
         """
-        raise NotImplementedError
+        # system attrs are read back by samplers, so they are not loss-tolerant
+        self._update_trial(trial_id, {"$set": {"system_attrs." + key: value}}, DURABILITY_SAFE)
 
     # Basic trial access
     def get_trial(self, trial_id: int) -> FrozenTrial:
@@ -618,16 +1746,10 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
                 If no trial with the matching ``trial_id`` exists.
         """
 
-        
-        # existance check
-        count = self.db.trial.count_documents({"trial_id": trial_id})
-        if count == 0:
+        trial_doc = self._find_trial_doc(trial_id)
+        if trial_doc is None:
             raise KeyError(trial_id)
-
-        trial_doc = self.db.trial.find_one({"trial_id": trial_id})
-        trial =(trial_id, trial_doc["study_id"], trial_doc["number"], trial_doc["state"], trial_doc["params"], trial_doc["distributions"], trial_doc["user_attrs"], trial_doc["system_attrs"], trial_doc["intermediate_values"], trial_doc["date_created"], trial_doc["date_updated"], trial_doc["date_completed"], trial_doc["date_terminated"])
-
-        return trial
+        return self._deserialize_trial(trial_doc)
 
     """
         Trial
@@ -675,112 +1797,573 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
                 If no study with the matching ``study_id`` exists.
         """
 
-        studies = self.db.study.count_documents({"study_id":study_id})
-        if studies == 0:
+        study = self._collection("study", bulk=True).find_one(
+            {"study_id": study_id}, projection={"archived": 1}, session=self._session()
+        )
+        if study is None:
             raise KeyError("No study with the matching study_id exists.")
 
-        ret = []
-        for trial in self.db.trial.find({"study_id":study_id}):
-            if states is None or trial["state"] in states:
-                ret.append(FrozenTrial(trial, deepcopy))        
-        return ret
+        state_values = [s.value for s in states] if states is not None else None
+        trial_docs = self._find_trial_docs(study_id, state_values, study.get("archived", False))
+        return [self._deserialize_trial(t) for t in trial_docs]
 
-    # def get_n_trials(
-    #     self, study_id: int, state: Optional[Union[Tuple[TrialState, ...], TrialState]] = None
-    # ) -> int:
-    #     """Count the number of trials in a study.
-    #     Args:
-    #         study_id:
-    #             ID of the study.
-    #         state:
-    #             Trial states to filter on. If :obj:`None`, include all states.
-    #     Returns:
-    #         Number of trials in the study.
-    #     Raises:
-    #         :exc:`KeyError`:
-    #             If no study with the matching ``study_id`` exists.
-    #     """
-    #     # TODO(hvy): Align the name and the behavior or the `state` parameter with
-    #     # `get_all_trials`'s `states`.
-    #     if isinstance(state, TrialState):
-    #         state = (state,)
-    #     return len(self.get_all_trials(study_id, deepcopy=False, states=state))
-
-    # def get_best_trial(self, study_id: int) -> FrozenTrial:
-    #     """Return the trial with the best value in a study.
-    #     This method is valid only during single-objective optimization.
-    #     Args:
-    #         study_id:
-    #             ID of the study.
-    #     Returns:
-    #         The trial with the best objective value among all finished trials in the study.
-    #     Raises:
-    #         :exc:`KeyError`:
-    #             If no study with the matching ``study_id`` exists.
-    #         :exc:`RuntimeError`:
-    #             If the study has more than one direction.
-    #         :exc:`ValueError`:
-    #             If no trials have been completed.
-    #     """
-    #     all_trials = self.get_all_trials(study_id, deepcopy=False)
-    #     all_trials = [t for t in all_trials if t.state is TrialState.COMPLETE]
+    def query_trials(
+        self,
+        study_ids: Sequence[int],
+        states: Optional[Container[TrialState]] = None,
+        fields: Optional[Sequence[str]] = None,
+        descending: bool = False,
+        cursor: Optional[Tuple[int, int]] = None,
+        limit: int = 1000,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[int, int]]]:
+        """Read one page of the trials of several studies.
+
+        Trials are ordered by ``(study_id, number)`` and paged by keyset, so a page costs one
+        indexed query on each trial collection regardless of its position. Bucketed and
+        archived trials are read by whole buckets and chunks, and only up to the page end.
+        Args:
+            study_ids:
+                IDs of the studies. Unknown IDs are ignored.
+            states:
+                Trial states to filter on. If :obj:`None`, include all states.
+            fields:
+                Trial document fields to return, e.g. ``["state", "values", "params.x"]``.
+                ``study_id``, ``number`` and ``trial_id`` are always returned. If :obj:`None`,
+                return whole documents.
+            descending:
+                Whether to return trials in descending ``(study_id, number)`` order.
+            cursor:
+                Cursor returned with the previous page, or :obj:`None` for the first page.
+            limit:
+                Maximum number of trials in the page.
+        Returns:
+            A pair of the trial documents of the page and the cursor of the next page. The
+            cursor is :obj:`None` once all trials have been read. A page may hold fewer than
+            ``limit`` trials even if more follow.
+        """
+        if limit <= 0:
+            raise ValueError("limit must be positive, got {}.".format(limit))
+        study_ids = sorted(set(study_ids), reverse=descending)
+        if len(study_ids) == 0:
+            return [], None
+
+        session = self._session()
+        sign = -1 if descending else 1
+        order = DESCENDING if descending else ASCENDING
+        after = "$lt" if descending else "$gt"
+        state_values = [s.value for s in states] if states is not None else None
+        keep = None if fields is None else set(fields) | {"study_id", "number", "trial_id"}
+        if keep is not None:
+            # a path inside a returned field is redundant, and the server rejects the pair
+            keep = {f for f in keep if not any(f.startswith(p + ".") for p in keep)}
+
+        # keys are negated for descending order, so that comparisons are always ascending
+        def key(study_id: int, number: int) -> Tuple[int, int]:
+            return sign * study_id, sign * number
+
+        number = cursor[1] if cursor is not None else None
+        start = key(*cursor) if cursor is not None else None
+        # keys up to end are complete, later keys may be missing from the page
+        end: Optional[Tuple[int, int]] = None
+
+        def selected(trial_doc: Dict[str, Any]) -> bool:
+            if state_values is not None and trial_doc["state"] not in state_values:
+                return False
+            return start is None or key(trial_doc["study_id"], trial_doc["number"]) > start
+
+        trial_docs: Dict[int, Dict[str, Any]] = {}
+
+        def read_ranges(name: str, range_field: str, with_states: bool) -> None:
+            # buckets and chunks hold contiguous number ranges and are read in order until
+            # they add up to a page
+            nonlocal end
+            bound = "max_number" if not descending else "min_number"
+            range_filter = _keyset_filter(study_ids, cursor, descending, {bound: {after: number}})
+            if with_states and state_values is not None:
+                range_filter = {
+                    "$and": [
+                        range_filter,
+                        {"$or": [{"states." + str(s): {"$gt": 0}} for s in state_values]},
+                    ]
+                }
+            with self._collection(name, bulk=True).find(
+                range_filter, sort=[("study_id", order), (range_field, order)], session=session
+            ) as ranges:
+                n = 0
+                for doc in ranges:
+                    if name == "trial_bucket":
+                        # a bucket may still receive trials up to the end of its number range
+                        lo = doc["bucket"] * self._bucket_size
+                        hi = lo + self._bucket_size - 1
+                    else:
+                        lo, hi = doc["min_number"], doc["max_number"]
+                    first, last = sorted((key(doc["study_id"], lo), key(doc["study_id"], hi)))
+                    if end is not None and first > end:
+                        break
+                    if name == "trial_bucket":
+                        docs = doc["trials"]
+                    else:
+                        docs = self._decode_archive_chunk(doc)
+                    for trial_doc in docs:
+                        if selected(trial_doc):
+                            trial_docs[trial_doc["trial_id"]] = trial_doc
+                            n += 1
+                    if n >= limit:
+                        end = last if end is None else min(end, last)
+                        break
+
+        # Hot trials are read first: a trial moved to a bucket in between is pushed to the
+        # bucket before it leaves the hot collection, so it is never missed.
+        trial_filter = _keyset_filter(study_ids, cursor, descending, {"number": {after: number}})
+        if state_values is not None:
+            trial_filter["state"] = {"$in": state_values}
+        projection: Dict[str, Any] = {"_id": 0}
+        if keep is not None:
+            projection.update({f: 1 for f in keep})
+        hot = (
+            self._collection("trial", bulk=True)
+            .find(trial_filter, projection=projection, session=session)
+            .sort([("study_id", order), ("number", order)])
+            .limit(limit)
+        )
+        for trial_doc in hot:
+            trial_docs[trial_doc["trial_id"]] = trial_doc
+        if len(trial_docs) == limit:
+            end = max(key(t["study_id"], t["number"]) for t in trial_docs.values())
+
+        if self._bucket_size is not None:
+            read_ranges("trial_bucket", "bucket", True)
+        # chunks hold no state counts
+        read_ranges("trial_archive", "chunk", False)
+
+        page = sorted(trial_docs.values(), key=lambda t: key(t["study_id"], t["number"]))
+        if end is not None:
+            page = [t for t in page if key(t["study_id"], t["number"]) <= end]
+        page = page[:limit]
+        if keep is not None:
+            # bucketed and archived trials are whole documents
+            page = [_project(t, keep) for t in page]
+        else:
+            page = [{k: v for k, v in t.items() if k != "_id"} for t in page]
 
-    #     if len(all_trials) == 0:
-    #         raise ValueError("No trials are completed yet.")
+        if len(page) == limit:
+            return page, (page[-1]["study_id"], page[-1]["number"])
+        if end is not None:
+            return page, (sign * end[0], sign * end[1])
+        return page, None
 
-    #     directions = self.get_study_directions(study_id)
-    #     if len(directions) > 1:
-    #         raise RuntimeError(
-    #             "Best trial can be obtained only for single-objective optimization."
-    #         )
-    #     direction = directions[0]
+    def get_param_observations(
+        self, study_id: int, param_name: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Read the observations of a parameter over the complete trials of a study.
 
-    #     if direction == StudyDirection.MAXIMIZE:
-    #         best_trial = max(all_trials, key=lambda t: cast(float, t.value))
-    #     else:
-    #         best_trial = min(all_trials, key=lambda t: cast(float, t.value))
+        The arrays are kept in-process and only the trials finished since the previous call
+        are fetched, with a projection on the parameter and the objective values.
+        Args:
+            study_id:
+                ID of the study.
+            param_name:
+                Name of the parameter.
+        Returns:
+            A pair of arrays. The first one holds the internal representations of the
+            parameter, shaped ``(n,)``, and the second one the objective values, shaped
+            ``(n, n_objectives)``. Complete trials without the parameter are skipped.
+            The arrays must not be modified.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+        """
+        study = self._collection("study", bulk=True).find_one(
+            {"study_id": study_id}, projection={"archived": 1}, session=self._session()
+        )
+        if study is None:
+            raise KeyError(study_id)
 
-    #     return best_trial
+        # The global lock only guards the registry, each entry has its own lock for the reads.
+        with self._observations_lock:
+            observations = self._observations.get((study_id, param_name))
+            if observations is None:
+                observations = _ParamObservations()
+                self._observations[(study_id, param_name)] = observations
+
+        with observations.lock:
+            for trial_doc in self._find_finished_trial_docs_since(
+                study_id, param_name, observations.watermark, study.get("archived", False)
+            ):
+                complete = trial_doc["state"] == TrialState.COMPLETE.value
+                observations.consume(
+                    trial_doc["finish_seq"],
+                    trial_doc["params"].get(param_name) if complete else None,
+                    trial_doc["values"] if complete else None,
+                )
+            observations.advance()
 
-    # def get_trial_params(self, trial_id: int) -> Dict[str, Any]:
-    #     """Read the parameter dictionary of a trial.
-    #     Args:
-    #         trial_id:
-    #             ID of the trial.
-    #     Returns:
-    #         Dictionary of a parameters. Keys are parameter names and values are internal
-    #         representations of the parameter values.
-    #     Raises:
-    #         :exc:`KeyError`:
-    #             If no trial with the matching ``trial_id`` exists.
-    #     """
-    #     return self.get_trial(trial_id).params
+            size = observations.size
+            values = observations.values
+            return (
+                observations.params[:size],
+                values[:size] if values is not None else np.empty((0, 0), dtype=np.float64),
+            )
 
-    # def get_trial_user_attrs(self, trial_id: int) -> Dict[str, Any]:
-    #     """Read the user-defined attributes of a trial.
-    #     Args:
-    #         trial_id:
-    #             ID of the trial.
-    #     Returns:
-    #         Dictionary with the user-defined attributes of the trial.
-    #     Raises:
-    #         :exc:`KeyError`:
-    #             If no trial with the matching ``trial_id`` exists.
-    #     """
-    #     return self.get_trial(trial_id).user_attrs
+    def _find_finished_trial_docs_since(
+        self, study_id: int, param_name: str, watermark: int, archived: bool
+    ) -> List[Dict[str, Any]]:
+        session = self._session()
+        fields = ["finish_seq", "state", "values", "params." + param_name]
+
+        trial_docs = list(
+            self._collection("trial", bulk=True).find(
+                {"study_id": study_id, "finish_seq": {"$gt": watermark}},
+                projection={f: 1 for f in fields},
+                session=session,
+            )
+        )
+        if self._bucket_size is not None:
+            cursor = self._collection("trial_bucket", bulk=True).find(
+                {"study_id": study_id, "max_finish_seq": {"$gt": watermark}},
+                projection={"trials." + f: 1 for f in fields},
+                session=session,
+            )
+            for bucket in cursor:
+                trial_docs.extend(
+                    t for t in bucket["trials"] if t.get("finish_seq", 0) > watermark
+                )
+        if archived:
+            cursor = self._collection("trial_archive", bulk=True).find(
+                {"study_id": study_id, "max_finish_seq": {"$gt": watermark}}, session=session
+            )
+            for chunk in cursor:
+                trial_docs.extend(
+                    t
+                    for t in self._decode_archive_chunk(chunk)
+                    if t.get("finish_seq", 0) > watermark
+                )
+        for trial_doc in trial_docs:
+            trial_doc.setdefault("params", {})
+        return trial_docs
+
+    def get_intermediate_value_percentiles(
+        self, study_id: int, step: int, percentiles: Sequence[float] = (50.0,)
+    ) -> Dict[str, Any]:
+        """Summarize the intermediate values of finished trials at a step.
+
+        Only :obj:`~optuna.trial.TrialState.COMPLETE` and
+        :obj:`~optuna.trial.TrialState.PRUNED` trials are taken into account. The reduction of
+        each trial's learning curve runs on the server, so only two floats per trial are
+        transferred. Results are cached for ``percentile_cache_ttl`` seconds.
+        Args:
+            study_id:
+                ID of the study.
+            step:
+                Step of the intermediate values.
+            percentiles:
+                Percentiles to compute, in the range ``[0, 100]``. ``50`` is the median.
+        Returns:
+            A dictionary with ``"n_trials"``, the number of trials reporting at ``step``,
+            ``"percentiles"``, the list of requested percentiles of the values at ``step``,
+            ``"best"``, the best value at ``step``, and ``"best_so_far"``, the best value
+            reported at any step up to ``step``. NaN values are ignored, and statistics
+            without any value are NaN.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+            :exc:`RuntimeError`:
+                If the study has more than one direction.
+        """
+        key = (study_id, step, tuple(percentiles))
+        cached = self._percentile_cache.get(key)
+        if cached is not _MISSING:
+            # callers may modify the result
+            return copy.deepcopy(cached)
+
+        directions = self.get_study_directions(study_id)
+        if len(directions) > 1:
+            raise RuntimeError(
+                "Intermediate values can be summarized only for single-objective optimization."
+            )
+        maximize = directions[0] == StudyDirection.MAXIMIZE
+
+        rows = self._reduce_intermediate_values(study_id, step, maximize)
+        at_step = np.array([r["value"] for r in rows if r.get("value") is not None], dtype=float)
+        so_far = np.array([r["so_far"] for r in rows if r.get("so_far") is not None], dtype=float)
+        at_step = at_step[~np.isnan(at_step)]
+        best = np.max if maximize else np.min
+        result = {
+            "n_trials": len(at_step),
+            "percentiles": [
+                float(np.percentile(at_step, q)) if len(at_step) > 0 else float("nan")
+                for q in percentiles
+            ],
+            "best": float(best(at_step)) if len(at_step) > 0 else float("nan"),
+            "best_so_far": float(best(so_far)) if len(so_far) > 0 else float("nan"),
+        }
+
+        if self._percentile_cache_ttl > 0:
+            self._percentile_cache.put(key, copy.deepcopy(result), self._percentile_cache_ttl)
+        return result
+
+    def _reduce_intermediate_values(
+        self, study_id: int, step: int, maximize: bool
+    ) -> List[Dict[str, Any]]:
+        session = self._session()
+        states = [TrialState.COMPLETE.value, TrialState.PRUNED.value]
+        reduce_op = "$max" if maximize else "$min"
+        stages = [
+            {"$match": {"state": {"$in": states}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "trial_id": 1,
+                    "value": "$intermediate_values." + str(step),
+                    "so_far": {
+                        reduce_op: {
+                            "$map": {
+                                "input": {
+                                    "$filter": {
+                                        "input": {"$objectToArray": "$intermediate_values"},
+                                        "cond": {
+                                            "$and": [
+                                                {"$lte": [{"$toLong": "$$this.k"}, step]},
+                                                # NaN sorts below every number in MongoDB
+                                                {"$ne": ["$$this.v", float("nan")]},
+                                            ]
+                                        },
+                                    }
+                                },
+                                "in": "$$this.v",
+                            }
+                        }
+                    },
+                }
+            },
+        ]
+
+        study = self._collection("study", bulk=True).find_one(
+            {"study_id": study_id}, projection={"archived": 1}, session=session
+        )
+        if study is not None and study.get("archived", False):
+            # archived trials are compressed, so they are reduced here instead
+            rows = []
+            for trial_doc in self._find_trial_docs(study_id, states, archived=True):
+                values = trial_doc["intermediate_values"]
+                earlier = [v for k, v in values.items() if int(k) <= step and not math.isnan(v)]
+                rows.append(
+                    {
+                        "trial_id": trial_doc["trial_id"],
+                        "value": values.get(str(step)),
+                        "so_far": (max if maximize else min)(earlier) if earlier else None,
+                    }
+                )
+            return rows
+
+        rows_by_id = {}
+        pipeline = [{"$match": {"study_id": study_id}}] + stages
+        for row in self._collection("trial", bulk=True).aggregate(pipeline, session=session):
+            rows_by_id[row["trial_id"]] = row
+        if self._bucket_size is not None:
+            pipeline = [
+                {
+                    "$match": {
+                        "study_id": study_id,
+                        "$or": [{"states." + str(s): {"$gt": 0}} for s in states],
+                    }
+                },
+                {"$unwind": "$trials"},
+                {"$replaceRoot": {"newRoot": "$trials"}},
+            ] + stages
+            cursor = self._collection("trial_bucket", bulk=True).aggregate(pipeline, session=session)
+            for row in cursor:
+                rows_by_id[row["trial_id"]] = row
+        return list(rows_by_id.values())
+
+    def get_pareto_front_trials(self, study_id: int) -> List[FrozenTrial]:
+        """Read the trials on the Pareto front of a study.
+
+        The front of a multi-objective study is maintained in storage as trials complete,
+        so this reads the non-dominated trials only. For a single-objective study, the best
+        trial is returned.
+        Args:
+            study_id:
+                ID of the study.
+        Returns:
+            List of non-dominated :obj:`~optuna.trial.TrialState.COMPLETE` trials, sorted by
+            number.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+        """
+        directions = self.get_study_directions(study_id)
+        if len(directions) == 1:
+            best_doc = self._find_best_trial_doc(study_id, directions[0])
+            if best_doc is None:
+                return []
+            return [self._deserialize_trial(best_doc)]
+
+        doc = self._collection("pareto_front").find_one(
+            {"study_id": study_id}, session=self._session()
+        )
+        if doc is None:
+            return []
+        trial_docs = self._find_trial_docs_by_ids([t["trial_id"] for t in doc["front"]])
+        trial_docs.sort(key=lambda t: t["number"])
+        return [self._deserialize_trial(t) for t in trial_docs]
+
+    def _find_trial_docs_by_ids(self, trial_ids: List[int]) -> List[Dict[str, Any]]:
+        session = self._session()
+        trial_docs = {}
+        cursor = self._collection("trial").find({"trial_id": {"$in": trial_ids}}, session=session)
+        for trial_doc in cursor:
+            trial_docs[trial_doc["trial_id"]] = trial_doc
+
+        missing = set(trial_ids) - set(trial_docs)
+        if len(missing) > 0 and self._bucket_size is not None:
+            buckets = {
+                (study_id, number // self._bucket_size)
+                for study_id, number in map(self._decode_trial_id, missing)
+            }
+            cursor = self._collection("trial_bucket").find(
+                {"$or": [{"study_id": s, "bucket": b} for s, b in buckets]}, session=session
+            )
+            for bucket in cursor:
+                for trial_doc in bucket["trials"]:
+                    if trial_doc["trial_id"] in missing:
+                        trial_docs[trial_doc["trial_id"]] = trial_doc
+
+        missing = set(trial_ids) - set(trial_docs)
+        if len(missing) > 0:
+            ranges = [
+                {
+                    "study_id": study_id,
+                    "min_number": {"$lte": number},
+                    "max_number": {"$gte": number},
+                }
+                for study_id, number in map(self._decode_trial_id, missing)
+            ]
+            cursor = self._collection("trial_archive").find({"$or": ranges}, session=session)
+            for chunk in cursor:
+                for trial_doc in self._decode_archive_chunk(chunk):
+                    if trial_doc["trial_id"] in missing:
+                        trial_docs[trial_doc["trial_id"]] = trial_doc
+        return list(trial_docs.values())
+
+    def get_n_trials(
+        self, study_id: int, state: Optional[Union[Tuple[TrialState, ...], TrialState]] = None
+    ) -> int:
+        """Count the number of trials in a study.
+        Args:
+            study_id:
+                ID of the study.
+            state:
+                Trial states to filter on. If :obj:`None`, include all states.
+        Returns:
+            Number of trials in the study.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+        """
+        if isinstance(state, TrialState):
+            state = (state,)
+        return len(self.get_all_trials(study_id, deepcopy=False, states=state))
 
-    # def get_trial_system_attrs(self, trial_id: int) -> Dict[str, Any]:
-    #     """Read the optuna-internal attributes of a trial.
-    #     Args:
-    #         trial_id:
-    #             ID of the trial.
-    #     Returns:
-    #         Dictionary with the optuna-internal attributes of the trial.
-    #     Raises:
-    #         :exc:`KeyError`:
-    #             If no trial with the matching ``trial_id`` exists.
-    #     """
-    #     return self.get_trial(trial_id).system_attrs
+    def get_best_trial(self, study_id: int) -> FrozenTrial:
+        """Return the trial with the best value in a study.
+        This method is valid only during single-objective optimization.
+        Args:
+            study_id:
+                ID of the study.
+        Returns:
+            The trial with the best objective value among all finished trials in the study.
+        Raises:
+            :exc:`KeyError`:
+                If no study with the matching ``study_id`` exists.
+            :exc:`RuntimeError`:
+                If the study has more than one direction.
+            :exc:`ValueError`:
+                If no trials have been completed.
+        """
+        directions = self.get_study_directions(study_id)
+        if len(directions) > 1:
+            raise RuntimeError(
+                "Best trial can be obtained only for single-objective optimization."
+            )
+        direction = directions[0]
+
+        best_doc = self._find_best_trial_doc(study_id, direction)
+        if best_doc is not None:
+            return self._deserialize_trial(best_doc)
+
+        # archived studies only have chunks
+        all_trials = self.get_all_trials(study_id, deepcopy=False, states=(TrialState.COMPLETE,))
+        if len(all_trials) == 0:
+            raise ValueError("No trials are completed yet.")
+        if direction == StudyDirection.MAXIMIZE:
+            return max(all_trials, key=lambda t: cast(float, t.value))
+        return min(all_trials, key=lambda t: cast(float, t.value))
+
+    def get_trial_params(self, trial_id: int) -> Dict[str, Any]:
+        """Read the parameter dictionary of a trial.
+        Args:
+            trial_id:
+                ID of the trial.
+        Returns:
+            Dictionary of a parameters. Keys are parameter names and values are internal
+            representations of the parameter values.
+        Raises:
+            :exc:`KeyError`:
+                If no trial with the matching ``trial_id`` exists.
+        """
+        return self.get_trial(trial_id).params
+
+    def get_trial_user_attrs(self, trial_id: int) -> Dict[str, Any]:
+        """Read the user-defined attributes of a trial.
+        Args:
+            trial_id:
+                ID of the trial.
+        Returns:
+            Dictionary with the user-defined attributes of the trial.
+        Raises:
+            :exc:`KeyError`:
+                If no trial with the matching ``trial_id`` exists.
+        """
+        return self._get_trial_field(trial_id, "user_attrs")
+
+    def get_trial_system_attrs(self, trial_id: int) -> Dict[str, Any]:
+        """Read the optuna-internal attributes of a trial.
+        Args:
+            trial_id:
+                ID of the trial.
+        Returns:
+            Dictionary with the optuna-internal attributes of the trial.
+        Raises:
+            :exc:`KeyError`:
+                If no trial with the matching ``trial_id`` exists.
+        """
+        return self._get_trial_field(trial_id, "system_attrs")
+
+    def _get_trial_field(self, trial_id: int, field: str) -> Any:
+        trial_doc = self._find_trial_doc(trial_id, projection={field: 1})
+        if trial_doc is None:
+            raise KeyError(trial_id)
+        return trial_doc[field]
+
+    def check_trial_is_updatable(self, trial_id: int, trial_state: TrialState) -> None:
+        """Check whether a trial state is updatable.
+        Args:
+            trial_id:
+                ID of the trial.
+                Only used for an error message.
+            trial_state:
+                Trial state to check.
+        Raises:
+            :exc:`RuntimeError`:
+                If the trial is already finished.
+        """
+        if trial_state.is_finished():
+            raise RuntimeError(
+                "Trial#{} has already finished and can not be updated.".format(
+                    self.get_trial_number_from_id(trial_id)
+                )
+            )
 
     def read_trials_from_remote_storage(self, study_id: int) -> None:
         """Make an internal cache of trials up-to-date.
@@ -791,8 +2374,7 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             :exc:`KeyError`:
                 If no study with the matching ``study_id`` exists.
         """
-        print("read_trials_from_remote_storage")
-        # raise NotImplementedError
+        pass
 
     # def remove_session(self) -> None:
     #     """Clean up all connections to a database."""
@@ -872,38 +2454,65 @@ class OptunaMongoStorage(object, metaclass=abc.ABCMeta):
             ret.append(StudyDirection(d))
         return ret
 
-    def _serialize_trial(self, trial:FrozenTrial):
-        ret = {}
-
-        if trial.number is not None:
-            ret['number'] = trial.number
-
-        if trial.state is not None:
-            ret['state'] = trial.state.value
-
-        if trial.value is not None:
-            ret['value'] = trial.value
-        
-        if trial.values is not None:
-            ret['values'] = trial.values
-
-        if trial.datetime_start is not None:
-             ret['datetime_start'] = trial.datetime_start.timestamp()
-        
-        if trial.datetime_complete is not None:
-            ret['datetime_complete'] = trial.datetime_complete.timestamp()
-
-        if trial.params is not None:
-            ret['params'] = trial.params
-
-        if trial.user_attrs is not None:
-            ret['user_attrs'] = trial.user_attrs
-
-        return ret
-
-
-    def _deserialize_trial(self, trial):
-        state = TrialState(trial.state)
-        datetime_start = trial.datetime_start
-        ret = FrozenTrial(number, state, value, datetime_start,datatime_complete,params,distribution,user_attrs,system_attrs,intermediate_values,trial_id,values)
-        return ret
+    # trial collection
+    # {
+    #   "trial_id": id of trial int
+    #   "study_id": id of study int
+    #   "number": number of trial in the study int
+    #   "state": TrialState value int
+    #   "values": objective values list or None
+    #   "datetime_start", "datetime_complete": datetime or None
+    #   "params": param name -> internal representation float
+    #   "distributions": param name -> distribution json string
+    #   "user_attrs", "system_attrs": dict
+    #   "intermediate_values": str(step) -> float
+    #   "finish_seq": position in the study's sequence of finished trials int (finished only)
+    #  }
+    def _serialize_trial(self, study_id: int, trial: FrozenTrial) -> Dict[str, Any]:
+        return {
+            "trial_id": trial._trial_id,
+            "study_id": study_id,
+            "number": trial.number,
+            "state": trial.state.value,
+            "values": list(trial.values) if trial.values is not None else None,
+            "datetime_start": trial.datetime_start,
+            "datetime_complete": trial.datetime_complete,
+            "params": {
+                name: trial.distributions[name].to_internal_repr(value)
+                for name, value in trial.params.items()
+            },
+            "distributions": {
+                name: distribution_to_json(dist) for name, dist in trial.distributions.items()
+            },
+            "user_attrs": trial.user_attrs,
+            "system_attrs": trial.system_attrs,
+            "intermediate_values": {
+                str(step): value for step, value in trial.intermediate_values.items()
+            },
+        }
+
+
+    def _deserialize_trial(self, trial_doc: Dict[str, Any]) -> FrozenTrial:
+        distributions = {
+            name: json_to_distribution(dist) for name, dist in trial_doc["distributions"].items()
+        }
+        params = {
+            name: distributions[name].to_external_repr(value)
+            for name, value in trial_doc["params"].items()
+        }
+        return FrozenTrial(
+            number=trial_doc["number"],
+            state=TrialState(trial_doc["state"]),
+            value=None,
+            values=trial_doc["values"],
+            datetime_start=trial_doc["datetime_start"],
+            datetime_complete=trial_doc["datetime_complete"],
+            params=params,
+            distributions=distributions,
+            user_attrs=trial_doc["user_attrs"],
+            system_attrs=trial_doc["system_attrs"],
+            intermediate_values={
+                int(step): value for step, value in trial_doc["intermediate_values"].items()
+            },
+            trial_id=trial_doc["trial_id"],
+        )
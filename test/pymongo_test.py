@@ -1,6 +1,17 @@
 import unittest
 import datetime
+import gc
+import threading
 import optuna
+import pytest
+from optuna.trial import TrialState
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from pymongo.write_concern import WriteConcern
+from optuna_mongo_storage.migration import export_study_to_jsonl
+from optuna_mongo_storage.migration import import_study
+from optuna_mongo_storage.migration import import_study_from_jsonl
+from optuna_mongo_storage.partitioned import PartitionedOptunaMongoStorage
 from optuna_mongo_storage.storage import OptunaMongoStorage
 
 # Define an objective function to be minimized.
@@ -16,6 +27,375 @@ def test_main():
     study.optimize(objective, n_trials=100)  # Invoke optimization of the objective function.
 
 
+def test_durability_profiles():
+    storage = OptunaMongoStorage(durability_profiles={"fast": {"write_concern": WriteConcern(w=1, j=True)}})
+    assert storage._collection("trial", "fast").write_concern.document == {"w": 1, "j": True}
+    assert storage._collection("trial", "safe").write_concern.document == {"w": "majority"}
+
+    study_id = storage.create_new_study("test durability " + str(datetime.datetime.now()))
+    trial_id = storage.create_new_trial(study_id)
+    storage.set_trial_intermediate_value(trial_id, 0, 1.0)
+    assert storage.set_trial_state_values(trial_id, TrialState.COMPLETE, [1.0])
+    with pytest.raises(RuntimeError):
+        storage.set_trial_user_attr(trial_id, "key", "value")
+
+
+def test_bulk_reads_see_own_writes():
+    storage = OptunaMongoStorage(bulk_read_preference="secondaryPreferred", max_staleness_seconds=90)
+    study_id = storage.create_new_study("test bulk reads " + str(datetime.datetime.now()))
+    trial_id = storage.create_new_trial(study_id)
+    storage.set_trial_state_values(trial_id, TrialState.COMPLETE, [1.0])
+
+    trials = storage.get_all_trials(study_id, states=(TrialState.COMPLETE,))
+    assert [t._trial_id for t in trials] == [trial_id]
+    summaries = storage.get_all_study_summaries(include_best_trial=False)
+    assert any(s._study_id == study_id and s.n_trials == 1 for s in summaries)
+
+
+def _replica_set_url(url="mongodb://127.0.0.1:27017"):
+    # e.g. a local three-member replica set started with `mongod --replSet rs0`
+    try:
+        hello = MongoClient(url, serverSelectionTimeoutMS=1000).admin.command("hello")
+    except Exception:
+        return None
+    if "setName" not in hello or len(hello.get("hosts", [])) < 2:
+        return None
+    return "{}/?replicaSet={}".format(url, hello["setName"])
+
+
+def test_secondary_reads_see_own_writes():
+    url = _replica_set_url()
+    if url is None:
+        pytest.skip("requires a replica set with at least one secondary")
+    storage = OptunaMongoStorage(url, bulk_read_preference="secondary")
+    assert storage._collection("trial", bulk=True).read_preference.mongos_mode == "secondary"
+
+    study_id = storage.create_new_study("test secondary reads " + str(datetime.datetime.now()))
+    for i in range(10):
+        trial_id = storage.create_new_trial(study_id)
+        storage.set_trial_state_values(trial_id, TrialState.COMPLETE, [float(i)])
+        # read back from a secondary right after the majority write
+        trials = storage.get_all_trials(study_id, states=(TrialState.COMPLETE,))
+        assert [t._trial_id for t in trials][-1] == trial_id
+        assert len(trials) == i + 1
+
+
+def test_sessions_end_with_threads():
+    storage = OptunaMongoStorage()
+    study_id = storage.create_new_study("test sessions " + str(datetime.datetime.now()))
+    threads = [threading.Thread(target=storage.create_new_trial, args=(study_id,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gc.collect()
+    # only the main thread's session is still open
+    assert sum(f.alive for f in storage._session_finalizers) == 1
+
+    storage.close()
+    assert storage._client is None
+    assert storage.get_study_name_from_id(study_id).startswith("test sessions")
+    assert storage.create_new_trial(study_id) is not None
+
+
+def test_partitioned_storage():
+    # Several local mongod processes work as well, e.g. ports 27017 and 27018.
+    storage = PartitionedOptunaMongoStorage(
+        ["mongodb://127.0.0.1:27017"] * 2, db=["optuna_partition0", "optuna_partition1"]
+    )
+    prefix = "test partitioned " + str(datetime.datetime.now())
+    study_ids = {}
+    for i in range(32):
+        study = optuna.create_study(storage=storage, study_name="{} {}".format(prefix, i))
+        study.optimize(objective, n_trials=3)
+        study_id = storage.get_study_id_from_name(study.study_name)
+        study_ids[study_id] = storage._partitions.index(storage._study_storage(study_id))
+        if len(set(study_ids.values())) == 2:
+            break
+    assert set(study_ids.values()) == {0, 1}
+
+    for study_id, partition in study_ids.items():
+        # each study lives on its own partition only
+        assert storage._partitions[partition].db.study.count_documents({"study_id": study_id}) == 1
+        assert storage._partitions[1 - partition].db.study.count_documents({"study_id": study_id}) == 0
+        for trial in storage.get_all_trials(study_id):
+            assert trial._trial_id & 0xFF == partition
+            assert storage.get_study_id_from_trial_id(trial._trial_id) == study_id
+            assert storage.get_trial(trial._trial_id).number == trial.number
+
+    summaries = storage.get_all_study_summaries(include_best_trial=True)
+    assert set(study_ids) <= {s._study_id for s in summaries}
+    page, _ = storage.query_trials(list(study_ids), limit=1000)
+    expected = sorted((study_id, n) for study_id in study_ids for n in range(3))
+    assert [(t["study_id"], t["number"]) for t in page] == expected
+
+
+def test_bucketed_storage():
+    storage = OptunaMongoStorage(db="optuna_bucketed", bucket_size=4)
+    study = optuna.create_study(storage=storage, study_name="test bucketed " + str(datetime.datetime.now()))
+    study.optimize(objective, n_trials=10)
+
+    study_id = storage.get_study_id_from_name(study.study_name)
+    assert storage.db.trial.count_documents({"study_id": study_id}) == 0
+    assert storage.db.trial_bucket.count_documents({"study_id": study_id}) == 3
+    trials = storage.get_all_trials(study_id, states=(TrialState.COMPLETE,))
+    assert [t.number for t in trials] == list(range(10))
+    with pytest.raises(RuntimeError):
+        storage.set_trial_user_attr(trials[0]._trial_id, "key", "value")
+
+
+def test_bucket_created_concurrently(monkeypatch):
+    storage = OptunaMongoStorage(db="optuna_bucketed", bucket_size=4)
+    study_id = storage.create_new_study("test bucket race " + str(datetime.datetime.now()))
+    storage.set_study_directions(study_id, [optuna.study.StudyDirection.MINIMIZE])
+    trial_id = storage.create_new_trial(study_id)
+
+    # another worker creates the bucket between the upsert's match and its insert
+    collection = storage._collection
+
+    class RacingBuckets(object):
+        def __init__(self, buckets):
+            self._buckets = buckets
+
+        def update_one(self, filter, update, upsert=False, **kwargs):
+            if upsert:
+                self._buckets.insert_one(
+                    {"study_id": study_id, "bucket": 0, "trials": [], "count": 0, "states": {}}
+                )
+                raise DuplicateKeyError("E11000 duplicate key error")
+            return self._buckets.update_one(filter, update, **kwargs)
+
+    def racing_collection(name, *args, **kwargs):
+        if name == "trial_bucket":
+            return RacingBuckets(collection(name, *args, **kwargs))
+        return collection(name, *args, **kwargs)
+
+    monkeypatch.setattr(storage, "_collection", racing_collection)
+    storage.set_trial_state_values(trial_id, TrialState.COMPLETE, [1.0])
+    monkeypatch.undo()
+
+    # the trial was moved into the other worker's bucket
+    assert storage.db.trial.count_documents({"trial_id": trial_id}) == 0
+    assert storage.get_trial(trial_id).values == [1.0]
+
+
+def test_archive_and_delete_study():
+    storage = OptunaMongoStorage()
+    study = optuna.create_study(storage=storage, study_name="test archive " + str(datetime.datetime.now()))
+    study.optimize(objective, n_trials=10)
+    study_id = storage.get_study_id_from_name(study.study_name)
+    expected = storage.get_all_trials(study_id)
+
+    running_id = storage.create_new_trial(study_id)
+    with pytest.raises(RuntimeError):
+        storage.archive_study(study_id, chunk_size=4)
+    # a failed archive leaves the study writable
+    storage.set_trial_state_values(running_id, TrialState.FAIL)
+    expected = storage.get_all_trials(study_id)
+
+    storage.archive_study(study_id, chunk_size=4)
+    assert storage.db.trial.count_documents({"study_id": study_id}) == 0
+    assert storage.get_all_trials(study_id) == expected
+    assert storage.get_trial(expected[5]._trial_id) == expected[5]
+    with pytest.raises(RuntimeError):
+        storage.create_new_trial(study_id)
+    storage.archive_study(study_id, chunk_size=4)
+    assert storage.get_all_trials(study_id) == expected
+
+    storage.delete_study(study_id)
+    assert storage.db.trial_archive.count_documents({"study_id": study_id}) == 0
+    with pytest.raises(KeyError):
+        storage.get_all_trials(study_id)
+
+
+def test_param_observations():
+    storage = OptunaMongoStorage()
+    study = optuna.create_study(storage=storage, study_name="test observations " + str(datetime.datetime.now()))
+    study_id = storage.get_study_id_from_name(study.study_name)
+
+    study.optimize(objective, n_trials=5)
+    params, values = storage.get_param_observations(study_id, "suggest")
+    assert params.shape == (5,) and values.shape == (5, 1)
+
+    study.optimize(objective, n_trials=5)
+    params, values = storage.get_param_observations(study_id, "suggest")
+    complete = storage.get_all_trials(study_id, states=(TrialState.COMPLETE,))
+    assert sorted(values[:, 0]) == sorted(t.value for t in complete)
+    # the sequence number is written together with the finished state
+    finish_seqs = [t["finish_seq"] for t in storage.db.trial.find({"study_id": study_id})]
+    assert sorted(finish_seqs) == list(range(1, 11))
+    # a rejected transition does not reserve a sequence number
+    with pytest.raises(RuntimeError):
+        storage.set_trial_state_values(complete[0]._trial_id, TrialState.FAIL)
+    assert storage.db.study.find_one({"study_id": study_id})["n_finished"] == 10
+
+
+def test_param_observations_holes(monkeypatch):
+    from optuna_mongo_storage import storage as storage_module
+
+    now = [0.0]
+    monkeypatch.setattr(storage_module.time, "monotonic", lambda: now[0])
+    observations = storage_module._ParamObservations()
+    observations.consume(2, 0.0, [0.0])
+    observations.advance()  # the hole at 1 is seen at 0s
+    now[0] = 30.0
+    observations.consume(1, 0.0, [0.0])
+    observations.consume(4, 0.0, [0.0])
+    observations.advance()  # the hole at 1 is filled, the hole at 3 is seen at 30s
+    assert observations.watermark == 2
+    now[0] = 61.0
+    observations.advance()
+    assert observations.watermark == 2
+    now[0] = 91.0
+    observations.advance()
+    assert observations.watermark == 4 and len(observations.pending) == 0
+
+
+def test_intermediate_value_percentiles():
+    storage = OptunaMongoStorage(percentile_cache_ttl=0.0)
+    study_id = storage.create_new_study("test percentiles " + str(datetime.datetime.now()))
+    storage.set_study_directions(study_id, [optuna.study.StudyDirection.MINIMIZE])
+    for i in range(5):
+        trial_id = storage.create_new_trial(study_id)
+        storage.set_trial_intermediate_value(trial_id, 0, float(i))
+        storage.set_trial_intermediate_value(trial_id, 1, float(i + 10))
+        storage.set_trial_state_values(trial_id, TrialState.PRUNED)
+
+    stats = storage.get_intermediate_value_percentiles(study_id, 1, percentiles=(0.0, 50.0))
+    assert stats["n_trials"] == 5
+    assert stats["percentiles"] == [10.0, 12.0]
+    assert stats["best"] == 10.0
+    assert stats["best_so_far"] == 0.0
+
+    # cached results are copies
+    cached_storage = OptunaMongoStorage(percentile_cache_ttl=60.0)
+    stats = cached_storage.get_intermediate_value_percentiles(study_id, 1, percentiles=(0.0, 50.0))
+    stats["percentiles"].append(100.0)
+    stats = cached_storage.get_intermediate_value_percentiles(study_id, 1, percentiles=(0.0, 50.0))
+    assert stats["percentiles"] == [10.0, 12.0]
+
+
+def test_pareto_front():
+    storage = OptunaMongoStorage()
+    study = optuna.create_study(
+        storage=storage,
+        study_name="test pareto " + str(datetime.datetime.now()),
+        directions=["minimize", "maximize", "minimize"],
+    )
+    study.optimize(lambda t: (t.suggest_float("x", 0, 1), t.suggest_float("y", 0, 1), t.suggest_float("z", 0, 1)), n_trials=30)
+    study_id = storage.get_study_id_from_name(study.study_name)
+
+    def dominates(a, b):
+        a, b = (a[0], -a[1], a[2]), (b[0], -b[1], b[2])
+        return all(x <= y for x, y in zip(a, b)) and a != b
+
+    trials = storage.get_all_trials(study_id, states=(TrialState.COMPLETE,))
+    expected = [t for t in trials if not any(dominates(o.values, t.values) for o in trials)]
+    assert storage.get_pareto_front_trials(study_id) == expected
+
+
+def test_migration(tmp_path):
+    source = optuna.create_study()
+    source.optimize(objective, n_trials=25)
+    storage = OptunaMongoStorage()
+    name = "test migration " + str(datetime.datetime.now())
+
+    study_id = import_study(source._storage, storage, source.study_name, name, chunk_size=10)
+    trials = storage.get_all_trials(study_id)
+    assert [t.params for t in trials] == [t.params for t in source.trials]
+
+    path = str(tmp_path / "study.jsonl")
+    assert export_study_to_jsonl(storage, name, path, chunk_size=10) == 25
+    copied_id = import_study_from_jsonl(path, storage, name + " copy", chunk_size=7, n_workers=2)
+    copied = storage.get_all_trials(copied_id)
+    assert [(t.number, t.values, t.params) for t in copied] == [(t.number, t.values, t.params) for t in trials]
+
+
+def test_bootstrap():
+    storage = OptunaMongoStorage()
+    study = optuna.create_study(storage=storage, study_name="test bootstrap " + str(datetime.datetime.now()))
+    bootstrap = storage.get_bootstrap(study.study_name)
+
+    worker = OptunaMongoStorage(bootstrap=bootstrap)
+    assert worker._client is None
+    assert worker.get_study_id_from_name(study.study_name) == bootstrap["study_id"]
+    assert worker.get_study_directions(bootstrap["study_id"]) == study.directions
+    assert worker._client is None
+
+    study = optuna.load_study(storage=worker, study_name=study.study_name)
+    study.optimize(objective, n_trials=1)
+
+    # prewarm reaches the server even without a session or a schema check
+    worker = OptunaMongoStorage(bootstrap=bootstrap, causal_consistency=False)
+    worker.prewarm()
+    assert worker._client is not None
+
+
+def test_trial_id_encodes_study():
+    storage = OptunaMongoStorage()
+    study = optuna.create_study(storage=storage, study_name="test trial id " + str(datetime.datetime.now()))
+    study.optimize(objective, n_trials=3)
+    study_id = storage.get_study_id_from_name(study.study_name)
+
+    trial_id = storage.get_trial_id_from_study_id_trial_number(study_id, 2)
+    assert storage.get_study_id_from_trial_id(trial_id) == study_id
+    assert storage.get_trial_number_from_id(trial_id) == 2
+    assert storage.get_trial(trial_id).number == 2
+    with pytest.raises(KeyError):
+        storage.get_trial_id_from_study_id_trial_number(study_id, 3)
+
+    # study IDs must fit into trial IDs
+    partitioned = OptunaMongoStorage(partition=1, partition_bits=8)
+    name = "test study id overflow " + str(datetime.datetime.now())
+    with pytest.raises(RuntimeError):
+        partitioned._insert_study(1 << 23, name)
+    with pytest.raises(KeyError):
+        partitioned.get_study_id_from_name(name)
+
+    # metadata is served from the cache once read
+    storage._client, storage._db = None, None
+    assert storage.get_study_name_from_id(study_id) == study.study_name
+    assert storage.get_study_directions(study_id) == study.directions
+    assert storage._client is None
+
+
+def test_query_trials():
+    storage = OptunaMongoStorage(db="optuna_bucketed", bucket_size=4)
+    study_ids = []
+    for n_trials in (7, 5):
+        study = optuna.create_study(storage=storage, study_name="test query " + str(datetime.datetime.now()))
+        study.optimize(objective, n_trials=n_trials)
+        study_ids.append(storage.get_study_id_from_name(study.study_name))
+    # a running trial stays in the hot collection
+    storage.create_new_trial(study_ids[0])
+
+    def read_all(**kwargs):
+        keys, cursor = [], None
+        while True:
+            page, cursor = storage.query_trials(study_ids, cursor=cursor, limit=3, **kwargs)
+            assert len(page) <= 3
+            keys.extend((t["study_id"], t["number"]) for t in page)
+            if cursor is None:
+                return keys
+
+    expected = [(study_ids[0], n) for n in range(8)] + [(study_ids[1], n) for n in range(5)]
+    assert read_all() == expected
+    assert read_all(descending=True) == expected[::-1]
+    assert read_all(states=(TrialState.COMPLETE,)) == expected[:7] + expected[8:]
+
+    page, _ = storage.query_trials(study_ids, fields=["values"], limit=1)
+    assert set(page[0]) == {"study_id", "number", "trial_id", "values"}
+
+    # dotted fields are projected the same way in every layout
+    for query_storage in (storage, OptunaMongoStorage()):
+        study = optuna.create_study(storage=query_storage, study_name="test query " + str(datetime.datetime.now()))
+        study.optimize(objective, n_trials=5)
+        study_id = query_storage.get_study_id_from_name(study.study_name)
+        page, _ = query_storage.query_trials([study_id], fields=["params.suggest", "user_attrs"])
+        assert [t["params"] for t in page] == [{"suggest": t.params["suggest"]} for t in study.trials]
+        assert all(set(t) == {"study_id", "number", "trial_id", "params", "user_attrs"} for t in page)
+
+
 # class TestOptunaStorage(unittest.TestCase):
 
 #     def test_study(self):